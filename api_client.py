@@ -1,47 +1,90 @@
 import datetime
 
-from sqlalchemy import func, or_
 import sqlalchemy.orm
-import sqlalchemy.exc
 
 import models
+import resolver
+from writer import BatchWriter
+
+
+def facility_ids_query(session, city_id, names):
+    """
+    Facilities of a city by case-folded names, answered by the (city_id, lower(name)) unique index
+
+    :return: Query (id, name)
+    """
+
+    return session.query(models.Facility.id, models.Facility.name).filter(
+        models.Facility.city_id == city_id,
+        sqlalchemy.func.lower(models.Facility.name).in_([sqlalchemy.func.lower(name) for name in names])
+    )
+
+
+def facility_page_query(service_ids, city_ids=None, after=None, limit=1000):
+    """
+    Keyset page of the facilities of services, see ScraperAPI.get_facility_page. The page of facilities
+    is read in the order of the (city_id, id) index, only the rows of the page are sorted.
+
+    :return: select (city_id, facility_id, service_id, name)
+    """
+
+    facility = models.Facility.__table__
+    facility_category = models.facility_category
+
+    page = facility.alias('page')
+    page_category = facility_category.alias('page_category')
+    page_query = sqlalchemy.select([page.c.id]).where(
+        sqlalchemy.exists().where(sqlalchemy.and_(
+            page_category.c.facility_id == page.c.id,
+            page_category.c.category_id.in_(list(service_ids))
+        ))
+    ).order_by(
+        page.c.city_id, page.c.id
+    ).limit(limit)
+
+    if city_ids is not None:
+        page_query = page_query.where(page.c.city_id.in_(list(city_ids)))
+
+    if after is not None:
+        page_query = page_query.where(sqlalchemy.tuple_(page.c.city_id, page.c.id) > sqlalchemy.tuple_(*after))
+
+    return sqlalchemy.select([
+        facility.c.city_id, facility.c.id, facility_category.c.category_id, facility.c.name
+    ]).select_from(
+        facility_category.join(facility, facility.c.id == facility_category.c.facility_id)
+    ).where(
+        facility.c.id.in_(page_query)
+    ).where(
+        facility_category.c.category_id.in_(list(service_ids))
+    ).order_by(
+        facility.c.city_id, facility.c.id, facility_category.c.category_id
+    )
 
 
 class ScraperAPI:
-    def __init__(self, base_address):
-        self.base_address = base_address
+    # Bound parameters of one IN (...) list
+    MAX_IN_PARAMETERS = 500
 
-    @staticmethod
-    async def __get_city(session, country, region, city):
-        city_query = (
-            session.query(models.City).select_from(
-                sqlalchemy.join(
-                    models.City,
-                    sqlalchemy.join(
-                        models.Region,
-                        models.Country,
-                        models.Region.country_id == models.Country.id
-                    ),
-                    models.City.region_id == models.Region.id
-                )
-            ).filter(
-                func.lower(models.City.name) == func.lower(city),
-            )
+    def __init__(self, base_address, batch_size=500, flush_interval=0.5):
+        self.base_address = base_address
+        self.writer = BatchWriter(
+            self.__write_batch, batch_size=batch_size, flush_interval=flush_interval,
+            after_flush=self.__bump_data_version
         )
 
-        if region is not None:
-            city_query = city_query.filter(or_(
-                func.lower(models.Region.name) == func.lower(region.get('name')),
-                func.lower(models.Region.code) == func.lower(region.get('code')),
-            ))
+    @staticmethod
+    async def __bump_data_version():
+        """
+        Invalidates the cached pages after a write. Every writer updates the same data_version row, the update
+        runs in its own short transaction so the row lock does not serialize the data transactions of the workers.
+        """
 
-        if country is not None:
-            city_query = city_query.filter(or_(
-                func.lower(models.Country.name) == func.lower(country.get('name')),
-                func.lower(models.Country.code) == func.lower(country.get('code')),
-            ))
+        def bump(session):
+            models.bump_data_version(session)
+            session.commit()
 
-        return city_query.first()
+        async with models.AsyncSession() as session:
+            await session.run(bump)
 
     async def post_facility(self, name, country, region, city):
         """
@@ -62,25 +105,25 @@ class ScraperAPI:
         if self.base_address is not None:
             raise NotImplementedError
 
-        async with models.AsyncSession() as session:
-            city_record = await self.__get_city(session, country, region, city)
-            if city_record is None:
+        def write_facility(session):
+            city_id = resolver.locations.resolve(session, country, region, city)
+            if city_id is None:
                 print(f"Unknown location {{'city':{city}, 'region':{region}, 'country':{country}}}")
                 return None
 
-            facility = session.query(models.Facility).filter(
-                func.lower(models.Facility.name) == func.lower(name),
-                models.Facility.city_id == city_record.id
-            ).first()
+            facility_ids = self.__upsert_facilities(session, {(city_id, name)})
+            session.commit()
 
-            if facility is None:
-                facility = models.Facility(name=name, city_id=city_record.id)
-                session.add(facility)
-                session.commit()
+            return facility_ids.get((city_id, name))
 
-            return facility.id
+        async with models.AsyncSession() as session:
+            facility_id = await session.run(write_facility)
 
-    async def post_facility_info(self, facility_id, source, about, logo, phone, website, address, geocoords, postal_code):
+        await self.__bump_data_version()
+        return facility_id
+
+    async def post_facility_info(self, facility_id, source, about, logo, phone, website, address, geocoords, postal_code,
+                                 page_url=None):
         """
         :param facility_id: Идентификатор клиники
         :param source: Источник данных ("yelp")
@@ -95,41 +138,34 @@ class ScraperAPI:
             longitude: (-79.3827503)
         }
         :param postal_code: Почтовый индекс ("M5B 1J3")
+        :param page_url: Страница клиники в источнике ("https://www.yelp.com/biz/back-in-balance-clinic-toronto")
         """
 
         if self.base_address is not None:
             raise NotImplementedError
 
-        async with models.AsyncSession() as session:
-            facility_info = session.query(models.FacilityInfo).filter(
-                models.FacilityInfo.facility_id == facility_id,
-                models.FacilityInfo.source == source
-            ).first()
-
-            if facility_info is None:
-                facility_info = models.FacilityInfo(
-                    facility_id=facility_id,
-                    source=source
-                )
-                session.add(facility_info)
-
-            facility_info.about = about
-            facility_info.phone = phone
-            facility_info.image_url = logo
-            facility_info.website_url = website
-            facility_info.address = address
-            facility_info.fetch_date = datetime.datetime.now(datetime.timezone.utc)
-
+        def write_facility_info(session):
             # todo: Remove the print
             print("<!>", postal_code, geocoords)
 
-            # facility_info.geocoords = geocoords
-            # facility_info.postal_code = postal_code
-            try:
-                session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                session.rollback()
-                raise
+            # geocoords and postal_code are not stored yet
+            self.__upsert_facility_infos(session, [{
+                'facility_id': facility_id,
+                'source': source,
+                'about': about,
+                'phone': phone,
+                'image_url': logo,
+                'website_url': website,
+                'address': address,
+                'page_url': page_url,
+                'fetch_date': datetime.datetime.now(datetime.timezone.utc),
+            }])
+            session.commit()
+
+        async with models.AsyncSession() as session:
+            await session.run(write_facility_info)
+
+        await self.__bump_data_version()
 
     async def post_facility_reviews(self, facility_id, source, rating, count):
         """
@@ -142,23 +178,368 @@ class ScraperAPI:
         if self.base_address is not None:
             raise NotImplementedError
 
+        def write_facility_reviews(session):
+            self.__upsert_reviews(session, [{
+                'facility_id': facility_id,
+                'source': source,
+                'rating': rating,
+                'count': count,
+                'fetch_date': datetime.datetime.now(datetime.timezone.utc),
+            }])
+            session.commit()
+
         async with models.AsyncSession() as session:
-            review = session.query(models.Review).filter(
-                models.Review.facility_id == facility_id,
-                models.Review.source == source
-            ).first()
-
-            if review is None:
-                review = models.Review(
-                    facility_id=facility_id,
-                    source=source
-                )
-                session.add(review)
+            await session.run(write_facility_reviews)
+
+        await self.__bump_data_version()
+
+    async def queue_facility(self, name, country, region, city, info=None, reviews=None, categories=None,
+                             category_ids=None):
+        """
+        Буферизированная запись клиники вместе с информацией и отзывами.
+        Идентификатор клиники определяется при записи пачки.
+
+        :param name: Название клиники ("Back in Balance Clinic")
+        :param country: Страна, как в post_facility
+        :param region: Регион, как в post_facility
+        :param city: Название города ("Toronto")
+        :param info: {
+            source, about, logo, phone, website, address, geocoords, postal_code, page_url
+        } как в post_facility_info
+        :param reviews: [
+            {source, rating, count},
+            ...
+        ] как в post_facility_reviews
+        :param categories: Названия категорий в источнике info ("Dentists", "Orthodontists")
+        :param category_ids: Идентификаторы категорий (категория поиска, нашедшего клинику)
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        await self.writer.put(('facility', {
+            'name': name,
+            'country': country,
+            'region': region,
+            'city': city,
+            'info': info,
+            'reviews': reviews or [],
+            'categories': categories or [],
+            'category_ids': category_ids or [],
+        }))
+
+    async def queue_facility_reviews(self, facility_id, source, rating, count):
+        """
+        Буферизированный вариант post_facility_reviews
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        await self.writer.put(('reviews', {
+            'facility_id': facility_id,
+            'source': source,
+            'rating': rating,
+            'count': count,
+        }))
+
+    async def queue_page_categories(self, source, page_urls, category_ids):
+        """
+        Буферизированная связь клиник, уже записанных или стоящих в очереди, с категориями.
+        Клиника определяется по странице в источнике (facility_info.page_url), страницы без клиники пропускаются.
+
+        :param source: Источник страниц ("yelp")
+        :param page_urls: Страницы клиник в источнике
+        :param category_ids: Идентификаторы категорий
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        for page_url in page_urls:
+            await self.writer.put(('page_categories', {
+                'source': source,
+                'page_url': page_url,
+                'category_ids': list(category_ids),
+            }))
+
+    async def flush(self):
+        await self.writer.flush()
+
+    async def close(self):
+        await self.writer.close()
+
+    def __write_batch(self, session, records):
+        fetch_date = datetime.datetime.now(datetime.timezone.utc)
+
+        # Locations
+        facility_records = []
+        for kind, record in records:
+            if kind != 'facility':
+                continue
+
+            city_id = resolver.locations.resolve(session, record['country'], record['region'], record['city'])
+            if city_id is None:
+                print(f"Unknown location {{'city':{record['city']}, 'region':{record['region']}, "
+                      f"'country':{record['country']}}}")
+                continue
+
+            facility_records.append((city_id, record))
+
+        # Facilities
+        facility_ids = self.__upsert_facilities(session, {
+            (city_id, record['name']) for city_id, record in facility_records
+        })
+
+        infos = {}
+        reviews = {}
+        categories = set()
+        for city_id, record in facility_records:
+            facility_id = facility_ids.get((city_id, record['name']))
+            if facility_id is None:
+                print(f"<!> Facility {record['name']} in city {city_id} is not found after the upsert")
+                continue
+
+            source = record['info']['source'] if record['info'] is not None else None
+            for category_name in record.get('categories', ()):
+                category_id = resolver.categories.resolve(session, source, category_name)
+                if category_id is not None:
+                    categories.add((facility_id, category_id))
+            for category_id in record.get('category_ids', ()):
+                categories.add((facility_id, category_id))
+
+            info = record['info']
+            if info is not None:
+                infos[(facility_id, info['source'])] = {
+                    'facility_id': facility_id,
+                    'source': info['source'],
+                    'about': info['about'],
+                    'phone': info['phone'],
+                    'image_url': info['logo'],
+                    'website_url': info['website'],
+                    'address': info['address'],
+                    'page_url': info.get('page_url'),
+                    'fetch_date': fetch_date,
+                }
+
+            for review in record['reviews']:
+                reviews[(facility_id, review['source'])] = dict(review, facility_id=facility_id, fetch_date=fetch_date)
+
+        for kind, record in records:
+            if kind == 'reviews':
+                reviews[(record['facility_id'], record['source'])] = dict(record, fetch_date=fetch_date)
+
+        # Pages of the batch first, then the pages written earlier
+        page_categories = [record for kind, record in records if kind == 'page_categories']
+        page_facility_ids = self.__page_facility_ids(session, infos.values(), {
+            (record['source'], record['page_url']) for record in page_categories
+        })
+        for record in page_categories:
+            facility_id = page_facility_ids.get((record['source'], record['page_url']))
+            if facility_id is not None:
+                categories.update((facility_id, category_id) for category_id in record['category_ids'])
+
+        self.__upsert_facility_categories(session, categories)
+        self.__upsert_facility_infos(session, list(infos.values()))
+        self.__upsert_reviews(session, list(reviews.values()))
+
+    def __page_facility_ids(self, session, infos, pages):
+        """
+        :param infos: Строки facility_info текущей пачки
+        :param pages: {(source, page_url), ...}
+        :return: {(source, page_url): facility_id, ...}
+        """
+
+        facility_ids = {
+            (info['source'], info['page_url']): info['facility_id']
+            for info in infos if (info['source'], info['page_url']) in pages
+        }
+
+        urls_by_source = {}
+        for source, page_url in pages:
+            if (source, page_url) not in facility_ids:
+                urls_by_source.setdefault(source, []).append(page_url)
+
+        for source, page_urls in urls_by_source.items():
+            for chunk in self.__chunks(page_urls):
+                for facility_id, page_url in session.query(
+                    models.FacilityInfo.facility_id, models.FacilityInfo.page_url
+                ).filter(
+                    models.FacilityInfo.source == source,
+                    models.FacilityInfo.page_url.in_(chunk)
+                ).all():
+                    facility_ids[(source, page_url)] = facility_id
+
+        return facility_ids
+
+    @staticmethod
+    def __upsert_facilities(session, facilities):
+        """
+        INSERT … ON CONFLICT DO NOTHING against the (city_id, lower(name)) unique index, then the ids are
+        fetched in bulk. Names are matched case-insensitively, the first written case is kept.
+        A single facility on PostgreSQL is written with one INSERT … RETURNING statement.
+
+        :param facilities: {(city_id, name), ...}
+        :return: {(city_id, name): facility_id, ...}
+        """
 
-            review.rating = rating
-            review.count = count
+        if len(facilities) == 0:
+            return {}
 
+        dialect = session.bind.dialect.name
+        table = models.Facility.__table__
+        index_elements = [table.c.city_id, sqlalchemy.func.lower(table.c.name)]
+
+        if dialect == 'postgresql' and len(facilities) == 1:
+            (city_id, name), = facilities
+            # The no-op update makes RETURNING give the id of an existing facility too
+            statement = models.upsert(dialect, table, index_elements, ['city_id']).returning(table.c.id)
+            return {(city_id, name): session.execute(statement.values(name=name, city_id=city_id)).scalar()}
+
+        session.execute(models.upsert(dialect, table, index_elements), [
+            {'city_id': city_id, 'name': name} for city_id, name in facilities
+        ])
+
+        names_by_city = {}
+        for city_id, name in facilities:
+            names_by_city.setdefault(city_id, []).append(name)
+
+        facility_ids = {}
+        for city_id, names in names_by_city.items():
+            ids_by_name = {}
+            ids_by_folded_name = {}
+            for facility_id, stored_name in facility_ids_query(session, city_id, names).all():
+                ids_by_name[stored_name] = facility_id
+                ids_by_folded_name[stored_name.lower()] = facility_id
+
+            for name in names:
+                facility_id = ids_by_name.get(name, ids_by_folded_name.get(name.lower()))
+                if facility_id is not None:
+                    facility_ids[(city_id, name)] = facility_id
+
+        return facility_ids
+
+    @staticmethod
+    def __upsert_facility_categories(session, categories):
+        """
+        :param categories: {(facility_id, category_id), ...} существующие связи не изменяются
+        """
+
+        if len(categories) == 0:
+            return
+
+        session.execute(models.upsert(
+            session.bind.dialect.name, models.facility_category, ['facility_id', 'category_id']
+        ), [
+            {'facility_id': facility_id, 'category_id': category_id}
+            for facility_id, category_id in sorted(categories)
+        ])
+
+    @staticmethod
+    def __upsert_facility_infos(session, rows):
+        """
+        facility_info keeps the latest fetch per source, every fetch is appended to facility_info_history
+        """
+
+        if len(rows) == 0:
+            return
+
+        session.execute(models.upsert(
+            session.bind.dialect.name, models.FacilityInfo.__table__,
+            index_elements=['facility_id', 'source'],
+            update_columns=['about', 'phone', 'image_url', 'website_url', 'address', 'page_url', 'fetch_date']
+        ), rows)
+        session.execute(models.FacilityInfoHistory.__table__.insert(), rows)
+
+    @staticmethod
+    def __upsert_reviews(session, rows):
+        if len(rows) == 0:
+            return
+
+        session.execute(models.upsert(
+            session.bind.dialect.name, models.Review.__table__,
+            index_elements=['facility_id', 'source'],
+            update_columns=['rating', 'count', 'fetch_date']
+        ), rows)
+
+    async def prune_facility_info_history(self, max_age):
+        """
+        :param max_age: datetime.timedelta, более старые записи истории удаляются
+        :return: Количество удаленных записей
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        def delete_history(session):
+            history = models.FacilityInfoHistory.__table__
+            result = session.execute(history.delete().where(
+                history.c.fetch_date < datetime.datetime.now(datetime.timezone.utc) - max_age
+            ))
             session.commit()
+            return result.rowcount
+
+        async with models.AsyncSession() as session:
+            return await session.run(delete_history)
+
+    async def get_fresh_pages(self, source, page_urls, max_age):
+        """
+        :param source: Источник данных ("yelp")
+        :param page_urls: Страницы клиник в источнике
+        :param max_age: datetime.timedelta
+        :return: Множество страниц, загруженных не раньше max_age назад
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        def query_fresh_pages(session):
+            fresh_pages = set()
+            for chunk in self.__chunks(list(page_urls)):
+                fresh_pages.update(page_url for page_url, in session.query(models.FacilityInfo.page_url).filter(
+                    models.FacilityInfo.source == source,
+                    models.FacilityInfo.page_url.in_(chunk),
+                    models.FacilityInfo.fetch_date >= datetime.datetime.now(datetime.timezone.utc) - max_age
+                ).all())
+            return fresh_pages
+
+        if len(page_urls) == 0:
+            return set()
+
+        async with models.AsyncSession() as session:
+            return await session.run(query_fresh_pages)
+
+    async def get_fresh_reviews(self, source, facility_ids, max_age):
+        """
+        :param source: Источник отзывов ("google")
+        :param facility_ids: Идентификаторы клиник
+        :param max_age: datetime.timedelta
+        :return: Множество клиник, отзывы которых загружены не раньше max_age назад
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        def query_fresh_reviews(session):
+            fresh_facilities = set()
+            for chunk in self.__chunks(list(facility_ids)):
+                fresh_facilities.update(facility_id for facility_id, in session.query(models.Review.facility_id).filter(
+                    models.Review.source == source,
+                    models.Review.facility_id.in_(chunk),
+                    models.Review.fetch_date >= datetime.datetime.now(datetime.timezone.utc) - max_age
+                ).all())
+            return fresh_facilities
+
+        if len(facility_ids) == 0:
+            return set()
+
+        async with models.AsyncSession() as session:
+            return await session.run(query_fresh_reviews)
+
+    @staticmethod
+    def __chunks(values, size=MAX_IN_PARAMETERS):
+        for start in range(0, len(values), size):
+            yield values[start:start + size]
 
     async def get_locations(self, source, filter_cities=None, filter_regions=None, filter_countries=None):
         """
@@ -194,7 +575,7 @@ class ScraperAPI:
         if self.base_address is not None:
             raise NotImplementedError
 
-        async with models.AsyncSession() as session:
+        def query_locations(session):
             location_query = session.query(models.City, models.Region, models.Country).select_from(
                 sqlalchemy.join(
                     models.City,
@@ -267,6 +648,9 @@ class ScraperAPI:
                 for country_id, country in locations.items()
             ]
 
+        async with models.AsyncSession() as session:
+            return await session.run(query_locations)
+
     async def get_services(self, source, query_categories=None):
         """
         :param query_categories:
@@ -284,39 +668,17 @@ class ScraperAPI:
         if self.base_address is not None:
             raise NotImplementedError
 
-        async with models.AsyncSession() as session:
-            category_query = (
-                session.query(models.Category, models.CategoryName).outerjoin(
-                    models.CategoryName,
-                    sqlalchemy.and_(
-                        models.CategoryName.category_id == models.Category.id,
-                        models.CategoryName.source == source
-                    )
-                ).filter(
-                    sqlalchemy.or_(
-                        models.CategoryName.id.is_(None),
-                        models.CategoryName.name.isnot(None)
-                    )
-                )
-            )
+        def query_services(session):
+            return resolver.categories.services(session, source, query_categories)
 
-            if query_categories is not None:
-                category_query = category_query.filter(models.Category.name.in_(query_categories))
-
-            services = [
-                {
-                    'id': category.id,
-                    'name': category.name if category_name is None else category_name.name
-                }
-                for category, category_name in category_query.all()
-            ]
-            return services
+        async with models.AsyncSession() as session:
+            return await session.run(query_services)
 
     async def get_facilities(self, service_id, city_id):
         if self.base_address is not None:
             raise NotImplementedError
 
-        async with models.AsyncSession() as session:
+        def query_facilities(session):
             facility_query = session.query(models.Facility).join(
                 models.Facility.categories
             ).filter(
@@ -331,3 +693,78 @@ class ScraperAPI:
                 }
                 for facility in facility_query.all()
             ]
+
+        async with models.AsyncSession() as session:
+            return await session.run(query_facilities)
+
+    async def get_facility_page(self, service_ids, city_ids=None, after=None, limit=1000):
+        """
+        Batched facility lookup of the review planner: the facilities of all (city, service) pairs are read
+        page by page with one keyset query instead of a query per pair. Every page runs in its own short session.
+
+        :param service_ids: Идентификаторы услуг (категорий)
+        :param city_ids: Идентификаторы городов (не больше MAX_IN_PARAMETERS) или None - все города
+        :param after: (city_id, facility_id) последней клиники предыдущей страницы или None
+        :param limit: Число клиник страницы
+        :return: [(city_id, facility_id, service_id, name), ...] по возрастанию (city_id, facility_id, service_id).
+            Меньше limit клиник - последняя страница
+        """
+
+        if self.base_address is not None:
+            raise NotImplementedError
+
+        if len(service_ids) == 0 or city_ids is not None and len(city_ids) == 0:
+            return []
+
+        query = facility_page_query(service_ids, city_ids, after, limit)
+
+        def query_page(session):
+            return [tuple(row) for row in session.execute(query).fetchall()]
+
+        async with models.AsyncSession() as session:
+            return await session.run(query_page)
+
+    async def iter_facility_groups(self, service_ids, city_ids=None, batch_size=1000):
+        """
+        Facilities of every (city, service) pair, read with get_facility_page as the caller consumes the groups.
+        No session is held between the pages, so a paused consumer does not keep a connection or a cursor.
+        Groups of a city are yielded when its last facility is read.
+
+        :param service_ids: Идентификаторы услуг (категорий)
+        :param city_ids: Идентификаторы городов или None - все города
+        :return: async generator (city_id, service_id, [{id, name}, ...])
+        """
+
+        # Long lists of cities are filtered here, a bound parameter per city would exceed the SQLite limits
+        query_city_ids = None
+        if city_ids is not None:
+            city_ids = set(city_ids)
+            if len(city_ids) <= self.MAX_IN_PARAMETERS:
+                query_city_ids = list(city_ids)
+
+        group_city_id, groups = None, {}
+        after = None
+        while True:
+            rows = await self.get_facility_page(service_ids, query_city_ids, after, batch_size)
+
+            for city_id, facility_id, service_id, name in rows:
+                if city_id != group_city_id:
+                    for group_service_id, facilities in sorted(groups.items()):
+                        yield group_city_id, group_service_id, facilities
+                    group_city_id, groups = city_id, {}
+
+                if city_ids is not None and city_id not in city_ids:
+                    continue
+
+                groups.setdefault(service_id, []).append({
+                    'id': facility_id,
+                    'name': name
+                })
+
+            if len({facility_id for _, facility_id, _, _ in rows}) < batch_size:
+                break
+            after = rows[-1][:2]
+
+        for group_service_id, facilities in sorted(groups.items()):
+            yield group_city_id, group_service_id, facilities
+
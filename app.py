@@ -4,15 +4,25 @@ import os
 import aiohttp_jinja2
 import jinja2
 import sqlalchemy
+import sqlalchemy.orm
 from aiohttp import web
 
 import models
+from page_cache import PageCache
 
 routes = web.RouteTableDef()
 
+TOP_PAGE_SIZE = 50
+TOP_PAGE_SIZE_MAX = 500
+
+PAGE_CACHE_SIZE = 256
+PAGE_CACHE_TTL = 300
+
+page_cache = PageCache(max_entries=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+
 
 async def get_location(city, region=None, country=None):
-    async with models.AsyncSession() as session:
+    def query_location(session):
         query = session.query(models.Country, models.Region, models.City).select_from(
             sqlalchemy.join(
                 models.Country,
@@ -40,26 +50,29 @@ async def get_location(city, region=None, country=None):
                 query = query.filter(models.Country.code == country['code'])
 
         results = []
-        for country, region, city in query.all():
+        for country_record, region_record, city_record in query.all():
             results.append({
                 'country': {
-                    'name': country.name,
-                    'code': country.code
+                    'name': country_record.name,
+                    'code': country_record.code
                 },
                 'region': {
-                    'name': region.name,
-                    'code': region.code
+                    'name': region_record.name,
+                    'code': region_record.code
                 },
                 'city': {
-                    'name': city.name
+                    'name': city_record.name
                 }
             })
 
         return results
 
+    async with models.AsyncSession() as session:
+        return await session.run(query_location)
+
 
 async def get_locations_categories():
-    async with models.AsyncSession() as session:
+    def query_locations_categories(session):
         query = session.query(
             models.Category, models.City, models.Region, models.Country
         ).join(
@@ -79,8 +92,8 @@ async def get_locations_categories():
             sqlalchemy.func.count(models.Facility.id) > 0
         )
 
-        for category, city, region, country in query.all():
-            yield (
+        return [
+            (
                 category.name,
                 {
                     'city': {
@@ -96,22 +109,99 @@ async def get_locations_categories():
                     }
                 }
             )
+            for category, city, region, country in query.all()
+        ]
 
-
-async def generate_result(city_name=None, region_name=None, country_name=None, categories=None):
     async with models.AsyncSession() as session:
-        last_fetch = (
-            session.query(
-                models.FacilityInfo.facility_id.label('facility_id'),
-                sqlalchemy.func.max(models.FacilityInfo.fetch_date).label('fetch_date')
+        results = await session.run(query_locations_categories)
+
+    for result in results:
+        yield result
+
+
+def top_facilities_query(session, city_name=None, region_name=None, country_name=None, categories=None):
+    """
+    Facilities with info ordered by their weighted rating: (facility id, total rating, total reviews)
+    """
+
+    # Weighted rating across all sources: sum(rating * count) / sum(count)
+    total_rating = sqlalchemy.func.coalesce(
+        sqlalchemy.func.sum(models.Review.rating * models.Review.count) /
+        sqlalchemy.func.nullif(sqlalchemy.func.sum(models.Review.count), 0),
+        0
+    )
+    total_reviews = sqlalchemy.func.coalesce(sqlalchemy.func.sum(models.Review.count), 0)
+
+    top_query = (
+        session.query(models.Facility.id, total_rating, total_reviews).select_from(
+            sqlalchemy.join(
+                models.Country,
+                sqlalchemy.join(
+                    models.Region,
+                    sqlalchemy.join(
+                        models.City,
+                        models.Facility,
+                        models.Facility.city_id == models.City.id
+                    ),
+                    models.City.region_id == models.Region.id
+                ),
+                models.Region.country_id == models.Country.id
+            ),
+        )
+        .outerjoin(models.Review, models.Review.facility_id == models.Facility.id)
+        .filter(models.Facility.fetches.any())
+        .group_by(models.Facility.id)
+        .order_by(
+            sqlalchemy.desc(total_rating),
+            sqlalchemy.desc(total_reviews),
+            sqlalchemy.asc(models.Facility.id)
+        )
+    )
+
+    if city_name is not None:
+        top_query = top_query.filter(
+            models.City.name == city_name
+        )
+
+    if region_name is not None:
+        top_query = top_query.filter(
+            sqlalchemy.or_(
+                models.Region.name == region_name,
+                models.Region.code == region_name
             )
-            .group_by(
-                models.FacilityInfo.facility_id,
-                models.FacilityInfo.source
+        )
+
+    if country_name is not None:
+        top_query = top_query.filter(
+            sqlalchemy.or_(
+                models.Country.name == country_name,
+                models.Country.code == country_name
             )
-            .subquery('last_fetch')
         )
 
+    if categories is not None and len(categories) > 0:
+        # noinspection PyUnresolvedReferences
+        top_query = top_query.filter(
+            models.Facility.categories.any(models.Category.name.in_(categories))
+        )
+
+    return top_query
+
+
+async def generate_result(city_name=None, region_name=None, country_name=None, categories=None, limit=None, offset=0):
+    def query_result(session):
+        top_query = top_facilities_query(session, city_name, region_name, country_name, categories)
+
+        if offset > 0:
+            top_query = top_query.offset(offset)
+
+        if limit is not None:
+            top_query = top_query.limit(limit)
+
+        top = top_query.all()
+        if len(top) == 0:
+            return []
+
         query = (
             session.query(models.Facility, models.FacilityInfo).select_from(
                 sqlalchemy.join(
@@ -122,10 +212,7 @@ async def generate_result(city_name=None, region_name=None, country_name=None, c
                             models.City,
                             sqlalchemy.join(
                                 models.Facility,
-                                sqlalchemy.join(
-                                    models.FacilityInfo, last_fetch,
-                                    models.FacilityInfo.facility_id == last_fetch.c.facility_id
-                                ),
+                                models.FacilityInfo,
                                 models.Facility.id == models.FacilityInfo.facility_id
                             ),
                             models.Facility.city_id == models.City.id
@@ -135,37 +222,18 @@ async def generate_result(city_name=None, region_name=None, country_name=None, c
                     models.Region.country_id == models.Country.id
                 ),
             )
-            .filter(models.FacilityInfo.fetch_date == last_fetch.c.fetch_date)
+            .filter(models.Facility.id.in_([facility_id for facility_id, _, _ in top]))
+            .options(
+                # Location is already joined, categories and reviews are loaded with one query each
+                sqlalchemy.orm.contains_eager(models.Facility.city)
+                .contains_eager(models.City.region)
+                .contains_eager(models.Region.country),
+                sqlalchemy.orm.selectinload(models.Facility.categories),
+                sqlalchemy.orm.selectinload(models.Facility.reviews),
+            )
             .order_by(sqlalchemy.asc(models.Facility.id))
         )
 
-        if city_name is not None:
-            query = query.filter(
-                models.City.name == city_name
-            )
-
-        if region_name is not None:
-            query = query.filter(
-                sqlalchemy.or_(
-                    models.Region.name == region_name,
-                    models.Region.code == region_name
-                )
-            )
-
-        if country_name is not None:
-            query = query.filter(
-                sqlalchemy.or_(
-                    models.Country.name == country_name,
-                    models.Country.code == country_name
-                )
-            )
-
-        if categories is not None and len(categories) > 0:
-            # noinspection PyUnresolvedReferences
-            query = query.filter(
-                models.Facility.categories.any(models.Category.name.in_(categories))
-            )
-
         facilities = {}
         for facility, facility_info in query.all():
             result = facilities.get(facility.id)
@@ -181,23 +249,15 @@ async def generate_result(city_name=None, region_name=None, country_name=None, c
                         category.name for category in facility.categories
                     ],
                     'info': [],
-                    'total_reviews': 0,
-                    'total_rating': 0,
-                    'sources': [],
+                    'sources': [
+                        {
+                            'name': review.source,
+                            'rating': float(review.rating),
+                            'reviews': review.count
+                        }
+                        for review in facility.reviews
+                    ],
                 }
-
-                for review in facility.reviews:
-                    result['total_rating'] += float(review.rating) * review.count
-                    result['total_reviews'] += review.count
-                    result['sources'].append({
-                        'name': review.source,
-                        'rating': float(review.rating),
-                        'reviews': review.count
-                    })
-
-                if result['total_reviews'] > 0:
-                    result['total_rating'] /= result['total_reviews']
-
                 facilities[facility.id] = result
 
             result['info'].append({
@@ -209,43 +269,72 @@ async def generate_result(city_name=None, region_name=None, country_name=None, c
                 'website_url': facility_info.website_url
             })
 
-        return list(sorted(facilities.values(), key=lambda x: (-x['total_rating'], -x['total_reviews'])))
+        return [
+            dict(
+                facilities[facility_id],
+                total_rating=float(facility_rating),
+                total_reviews=int(facility_reviews)
+            )
+            for facility_id, facility_rating, facility_reviews in top
+        ]
+
+    async with models.AsyncSession() as session:
+        return await session.run(query_result)
 
 
 @routes.get('/')
-@aiohttp_jinja2.template('tops.html')
 async def index(request):
-    categories = []
-    async for result in get_locations_categories():
-        categories.append(result)
+    async def get_context():
+        categories = []
+        async for result in get_locations_categories():
+            categories.append(result)
 
-    return {
-        'categories': categories
-    }
+        return {
+            'categories': categories
+        }
+
+    return await page_cache.render(request, ('index',), 'tops.html', get_context)
 
 
 @routes.get('/{region}/{city}/{category}')
-@aiohttp_jinja2.template('tophealth.html')
 async def get_top(request):
     category = request.match_info['category']
     region_code = request.match_info['region']
     city_name = request.match_info['city']
 
-    location, = await get_location(
-        city={'name': city_name},
-        region={'code': region_code},
-    )
+    try:
+        limit = min(max(int(request.query.get('limit', TOP_PAGE_SIZE)), 1), TOP_PAGE_SIZE_MAX)
+        offset = max(int(request.query.get('offset', 0)), 0)
+    except ValueError:
+        raise web.HTTPBadRequest(text="'limit' and 'offset' must be integers")
 
-    facilities = await generate_result(
-        city_name=city_name,
-        region_name=region_code,
-        categories=[category]
+    async def get_context():
+        location, = await get_location(
+            city={'name': city_name},
+            region={'code': region_code},
+        )
+
+        # One extra row tells whether there is a next page
+        facilities = await generate_result(
+            city_name=city_name,
+            region_name=region_code,
+            categories=[category],
+            limit=limit + 1,
+            offset=offset
+        )
+        return {
+            "category": category,
+            "location": location,
+            "facilities": facilities[:limit],
+            "limit": limit,
+            "offset": offset,
+            "previous_offset": max(offset - limit, 0) if offset > 0 else None,
+            "next_offset": offset + limit if len(facilities) > limit else None,
+        }
+
+    return await page_cache.render(
+        request, ('top', region_code, city_name, category, limit, offset), 'tophealth.html', get_context
     )
-    return {
-        "category": category,
-        "location": location,
-        "facilities": facilities
-    }
 
 
 async def create_app():
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Measures the parse throughput of the scrapers over the pages of an HTTP cache (`tophealth.py --http-cache`)
+for every available parser backend, with and without restricted (SoupStrainer) parsing.
+
+    python benchmark_parsing.py http-cache --repeat 3
+
+Results of every configuration are compared with the html.parser one, a mismatch means the restricted
+parsing dropped an element the extraction needs.
+"""
+import argparse
+import time
+import urllib.parse
+
+from http_cache import HttpCache
+from scrapers import parsing
+from scrapers.task import BlockedError
+
+
+def extractor(url):
+    """
+    :return: Функция извлечения для страницы или None
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    if parts.netloc.endswith('yelp.com') and parts.path.startswith('/search'):
+        return lambda text: parsing.extract_yelp_search(text, url)
+    if parts.netloc.endswith('yelp.com') and parts.path.startswith('/biz/'):
+        return parsing.extract_yelp_facility
+    if parts.netloc.endswith('google.com') and 'tbm=lcl' in parts.query:
+        return parsing.extract_google_local
+    if parts.netloc.endswith('google.com') and parts.path.startswith('/search'):
+        return parsing.extract_google_reviews
+    if parts.netloc.endswith('opencare.com'):
+        return parsing.extract_opencare_listing
+    return None
+
+
+def extract(function, text):
+    try:
+        return function(text)
+    except BlockedError:
+        return BlockedError
+    except Exception as ex:
+        return repr(ex)
+
+
+def load_pages(cache):
+    pages = []
+    for url in cache.urls():
+        function = extractor(url)
+        cached = cache.get(url)
+        if function is None or cached is None:
+            continue
+
+        record, body = cached
+        pages.append((url, function, body.decode(record['encoding'] or 'utf-8', errors='replace')))
+    return pages
+
+
+def benchmark(pages, backend, strain, repeat):
+    """
+    :return: (секунд на все страницы, [результат для каждой страницы])
+    """
+
+    parsing.configure(parser_backend=backend, restrict=strain)
+
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        results = [extract(function, text) for _, function, text in pages]
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('http_cache', help="Directory of the scraped pages cache")
+    parser.add_argument('--repeat', type=int, default=3, help="Runs of every configuration, the best is reported")
+    args = parser.parse_args()
+
+    cache = HttpCache(args.http_cache).open()
+    pages = load_pages(cache)
+    cache.close()
+
+    if len(pages) == 0:
+        print(f"No scraped pages in {args.http_cache}")
+        return
+
+    megabytes = sum(len(text) for _, _, text in pages) / 2 ** 20
+    print(f"{len(pages)} pages, {megabytes:.1f} MB")
+
+    baseline_elapsed, baseline = benchmark(pages, 'html.parser', False, args.repeat)
+    print(f"{'html.parser':>12} {'full':>10}: {len(pages) / baseline_elapsed:8.1f} pages/s")
+
+    for backend in parsing.BACKENDS:
+        for strain in (False, True):
+            if backend == 'html.parser' and not strain:
+                continue
+
+            elapsed, results = benchmark(pages, backend, strain, args.repeat)
+            mismatches = [url for (url, _, _), result, expected in zip(pages, results, baseline) if result != expected]
+            print(
+                f"{backend:>12} {'restricted' if strain else 'full':>10}: {len(pages) / elapsed:8.1f} pages/s, "
+                f"x{baseline_elapsed / elapsed:.1f}" + (f", {len(mismatches)} mismatches" if mismatches else '')
+            )
+            for url in mismatches[:5]:
+                print(f"    {url}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import hashlib
+import math
+import urllib.parse
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def normalize_url(url):
+    """
+    :param url: URL страницы ("HTTPS://www.Yelp.com:443/biz/clinic/?b=2&a=1#reviews")
+    :return: URL без фрагмента, порта по умолчанию и регистра хоста, с сортированными параметрами
+        ("https://www.yelp.com/biz/clinic?a=1&b=2")
+    """
+
+    parts = urllib.parse.urlsplit(url)
+    scheme = parts.scheme.lower()
+
+    netloc = (parts.hostname or '').lower()
+    if parts.port is not None and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc += f':{parts.port}'
+
+    path = parts.path.rstrip('/') or '/'
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(parts.query, keep_blank_values=True)))
+    return urllib.parse.urlunsplit((scheme, netloc, path, query, ''))
+
+
+class BloomFilter:
+    """
+    Fixed-size set of strings with false positives at `error_rate` while it holds up to `capacity` items.
+    The bit positions are derived from one sha1 digest by double hashing.
+    """
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.__bits = bytearray((self.size + 7) // 8)
+        self.__count = 0
+
+    def __len__(self):
+        return self.__count
+
+    def __positions(self, item):
+        digest = hashlib.sha1(item.encode('utf-8')).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:16], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def __contains__(self, item):
+        return all(self.__bits[position >> 3] & (1 << (position & 7)) for position in self.__positions(item))
+
+    def add(self, item):
+        """
+        :return: False, если элемент (вероятно) уже был добавлен
+        """
+
+        added = False
+        for position in self.__positions(item):
+            mask = 1 << (position & 7)
+            if not self.__bits[position >> 3] & mask:
+                self.__bits[position >> 3] |= mask
+                added = True
+
+        if added:
+            self.__count += 1
+        return added
+
+
+class SeenUrls:
+    """
+    Pages already queued in a run. An exact set by default, a Bloom filter for very large runs
+    (a false positive skips a page).
+    """
+
+    def __init__(self, capacity=None):
+        """
+        :param capacity: Ожидаемое число страниц для Bloom-фильтра, None - точное множество
+        """
+
+        self.__urls = set() if capacity is None else BloomFilter(capacity)
+
+    def __len__(self):
+        return len(self.__urls)
+
+    def __contains__(self, url):
+        return normalize_url(url) in self.__urls
+
+    def add(self, url):
+        """
+        :return: False, если страница уже встречалась
+        """
+
+        url = normalize_url(url)
+        if isinstance(self.__urls, BloomFilter):
+            return self.__urls.add(url)
+
+        if url in self.__urls:
+            return False
+        self.__urls.add(url)
+        return True
@@ -3,6 +3,7 @@ import os
 
 import sqlalchemy.exc
 import models
+import resolver
 
 
 def create_data(session):
@@ -87,3 +88,10 @@ def create_data(session):
                 session.commit()
             except sqlalchemy.exc.IntegrityError:
                 session.rollback()
+
+    models.bump_data_version(session)
+    session.commit()
+
+    # Reference data is cached by the resolvers
+    resolver.locations.invalidate()
+    resolver.categories.invalidate()
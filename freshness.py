@@ -0,0 +1,56 @@
+import datetime
+
+
+# How long fetched data stays fresh, per source
+DEFAULT_MAX_AGE = {
+    'yelp': datetime.timedelta(days=7),
+    'google': datetime.timedelta(days=14),
+    'opencare': datetime.timedelta(days=14),
+}
+
+
+class FreshnessPolicy:
+    """
+    Decides which facilities are re-fetched by a recurring run. Pages and reviews fetched
+    from a source less than `max_age` ago are skipped, `max_age` overrides the per-source defaults
+    and zero disables the check.
+    """
+
+    def __init__(self, max_age=None, defaults=None):
+        self.override = max_age
+        self.defaults = DEFAULT_MAX_AGE if defaults is None else defaults
+
+    def max_age(self, source):
+        """
+        :return: datetime.timedelta или None, если свежесть не проверяется
+        """
+
+        max_age = self.override if self.override is not None else self.defaults.get(source)
+        if max_age is None or max_age <= datetime.timedelta(0):
+            return None
+        return max_age
+
+    async def stale_pages(self, api, source, page_urls):
+        """
+        :return: Страницы из page_urls, которые нужно загрузить заново (в исходном порядке)
+        """
+
+        max_age = self.max_age(source)
+        if max_age is None:
+            return list(page_urls)
+
+        fresh_pages = await api.get_fresh_pages(source, page_urls, max_age)
+        return [page_url for page_url in page_urls if page_url not in fresh_pages]
+
+    async def stale_facilities(self, api, source, facilities):
+        """
+        :param facilities: [{id, name}, ...]
+        :return: Клиники, отзывы которых из source нужно загрузить заново
+        """
+
+        max_age = self.max_age(source)
+        if max_age is None:
+            return list(facilities)
+
+        fresh_facilities = await api.get_fresh_reviews(source, [facility['id'] for facility in facilities], max_age)
+        return [facility for facility in facilities if facility['id'] not in fresh_facilities]
@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+
+
+class FrontierJournal:
+    """
+    Append-only journal of the crawl frontier. Every task is recorded as its kind (class name)
+    and constructor parameters, so a crashed run can be resumed:
+
+        {"add": key, "kind": "ExtractFacilityYelp", "params": {...}, "attempts": 10}
+        {"retry": key, "attempts": 9}
+        {"update": key, "params": {...}}
+        {"done": key}
+
+    Tasks already done or queued are not added twice. Finished tasks are recorded as done only by `commit`,
+    after the data they produced is written. The journal is removed when the run completes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.__tasks = {}
+        self.__done = set()
+        self.__finished = []
+        self.__file = None
+
+    @staticmethod
+    def key(kind, params):
+        return hashlib.sha1(json.dumps([kind, params], sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load(self):
+        """
+        :return: [(key, kind, params, attempts), ...] задачи, не завершенные в прошлом запуске
+        """
+
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line of a crashed run may be incomplete
+                        continue
+
+                    if 'add' in record:
+                        self.__tasks[record['add']] = (record['kind'], record['params'], record['attempts'])
+                    elif 'retry' in record and record['retry'] in self.__tasks:
+                        kind, params, _ = self.__tasks[record['retry']]
+                        self.__tasks[record['retry']] = (kind, params, record['attempts'])
+                    elif 'update' in record and record['update'] in self.__tasks:
+                        kind, _, attempts = self.__tasks[record['update']]
+                        self.__tasks[record['update']] = (kind, record['params'], attempts)
+                    elif 'done' in record:
+                        self.__tasks.pop(record['done'], None)
+                        self.__done.add(record['done'])
+
+        # Compact the journal
+        self.__file = open(self.path + '.tmp', 'w')
+        for key in self.__done:
+            self.__write({'done': key})
+        for key, (kind, params, attempts) in self.__tasks.items():
+            self.__write({'add': key, 'kind': kind, 'params': params, 'attempts': attempts})
+        self.__file.close()
+        os.replace(self.path + '.tmp', self.path)
+        self.__file = open(self.path, 'a')
+
+        return [(key, kind, params, attempts) for key, (kind, params, attempts) in self.__tasks.items()]
+
+    def __write(self, record):
+        self.__file.write(json.dumps(record) + '\n')
+
+    def add(self, kind, params, attempts):
+        """
+        :return: Ключ задачи или None, если задача уже выполнена или в очереди
+        """
+
+        key = self.key(kind, params)
+        if key in self.__done or key in self.__tasks:
+            return None
+
+        self.__tasks[key] = (kind, params, attempts)
+        self.__write({'add': key, 'kind': kind, 'params': params, 'attempts': attempts})
+        self.__file.flush()
+        return key
+
+    def retry(self, key, attempts):
+        kind, params, _ = self.__tasks[key]
+        self.__tasks[key] = (kind, params, attempts)
+        self.__write({'retry': key, 'attempts': attempts})
+        self.__file.flush()
+
+    def update(self, key, params):
+        """
+        Replaces the parameters of a queued task, e.g. merged from a duplicate. The key of the task is kept
+        """
+
+        if key not in self.__tasks:
+            return
+
+        kind, _, attempts = self.__tasks[key]
+        self.__tasks[key] = (kind, params, attempts)
+        self.__write({'update': key, 'params': params})
+        self.__file.flush()
+
+    def done(self, key):
+        self.__tasks.pop(key, None)
+        self.__done.add(key)
+        self.__finished.append(key)
+
+    def checkpoint(self):
+        """
+        :return: Ключи задач, завершенных с прошлого checkpoint. Передаются в commit после записи данных
+        """
+
+        keys, self.__finished = self.__finished, []
+        return keys
+
+    def commit(self, keys):
+        for key in keys:
+            self.__write({'done': key})
+        self.__file.flush()
+
+    def close(self, completed):
+        self.__file.close()
+        if completed and len(self.__tasks) == 0 and len(self.__finished) == 0:
+            os.remove(self.path)
@@ -0,0 +1,229 @@
+import datetime
+import gzip
+import hashlib
+import json
+import os
+
+
+class CacheMiss(LookupError):
+    """
+    The page is not in the cache in replay mode
+    """
+
+
+class CachedResponse:
+    """
+    The part of aiohttp.ClientResponse the scrapers use, backed by a cached or a freshly read body
+    """
+
+    def __init__(self, url, status, body, encoding, from_cache):
+        self.url = url
+        self.status = status
+        self.body = body
+        self.encoding = encoding
+        self.from_cache = from_cache
+
+    async def read(self):
+        return self.body
+
+    async def text(self):
+        return self.body.decode(self.encoding or 'utf-8', errors='replace')
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+
+class HttpCache:
+    """
+    On-disk cache of scraped pages. Bodies are stored gzip-compressed under the sha1 of the content,
+    so pages that did not change between fetches share one file:
+
+        objects/3f/3f786850e387550fdab836ed7e6dc881de23001b.gz
+
+    The index is an append-only JSON-lines file, the last record of an URL wins:
+
+        {"url": "...", "digest": "3f78...", "encoding": "utf-8", "etag": "...", "last_modified": "...",
+         "fetch_date": "2018-09-01T12:00:00+00:00"}
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__index = {}
+        self.__file = None
+
+    @property
+    def index_path(self):
+        return os.path.join(self.directory, 'index.jsonl')
+
+    def object_path(self, digest):
+        return os.path.join(self.directory, 'objects', digest[:2], digest + '.gz')
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # The last line of a crashed run may be incomplete
+                        continue
+
+                    if record.get('digest') is None:
+                        self.__index.pop(record['url'], None)
+                    else:
+                        self.__index[record['url']] = record
+
+        # Compact the index
+        with open(self.index_path + '.tmp', 'w') as f:
+            for record in self.__index.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(self.index_path + '.tmp', self.index_path)
+        self.__file = open(self.index_path, 'a')
+
+        return self
+
+    def close(self):
+        if self.__file is not None:
+            self.__file.close()
+            self.__file = None
+
+    def __len__(self):
+        return len(self.__index)
+
+    def urls(self):
+        return list(self.__index)
+
+    def __write(self, record):
+        self.__file.write(json.dumps(record) + '\n')
+        self.__file.flush()
+
+    def get(self, url):
+        """
+        :return: (record, body) или None, если страницы нет в кэше
+        """
+
+        record = self.__index.get(url)
+        if record is None:
+            return None
+
+        try:
+            with gzip.open(self.object_path(record['digest']), 'rb') as f:
+                return record, f.read()
+        except OSError:
+            # The object was removed by hand
+            return None
+
+    def put(self, url, body, encoding, etag=None, last_modified=None):
+        digest = hashlib.sha1(body).hexdigest()
+
+        object_path = self.object_path(digest)
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with gzip.open(object_path + '.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(object_path + '.tmp', object_path)
+
+        record = self.__index[url] = {
+            'url': url,
+            'digest': digest,
+            'encoding': encoding,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetch_date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        self.__write(record)
+        return record
+
+    def touch(self, url):
+        """
+        Records a successful revalidation (304 Not Modified)
+        """
+
+        record = self.__index[url] = dict(
+            self.__index[url], fetch_date=datetime.datetime.now(datetime.timezone.utc).isoformat()
+        )
+        self.__write(record)
+
+    def discard(self, url):
+        """
+        Forgets a page, e.g. a captcha that was served with 200 OK
+        """
+
+        if self.__index.pop(url, None) is not None:
+            self.__write({'url': url, 'digest': None})
+
+
+class CachedSession:
+    """
+    Wraps aiohttp.ClientSession for the scrapers. Cached pages are revalidated with If-None-Match and
+    If-Modified-Since, a 304 answer is served from the cache. In replay mode the network is not used at all
+    and pages missing from the cache raise CacheMiss.
+    """
+
+    def __init__(self, session, cache: HttpCache, replay=False):
+        self.session = session
+        self.cache = cache
+        self.replay = replay
+
+    def get(self, url, **kwargs):
+        return _CachedRequest(self, url, kwargs)
+
+    def discard(self, url):
+        self.cache.discard(url)
+
+    async def fetch(self, url, **kwargs):
+        cached = self.cache.get(url)
+
+        if self.replay:
+            if cached is None:
+                raise CacheMiss(url)
+            record, body = cached
+            return CachedResponse(url, 200, body, record['encoding'], from_cache=True)
+
+        headers = dict(kwargs.pop('headers', None) or {})
+        if cached is not None:
+            record, _ = cached
+            if record['etag'] is not None:
+                headers['If-None-Match'] = record['etag']
+            if record['last_modified'] is not None:
+                headers['If-Modified-Since'] = record['last_modified']
+
+        async with self.session.get(url, headers=headers, **kwargs) as response:
+            if response.status == 304 and cached is not None:
+                record, body = cached
+                self.cache.touch(url)
+                return CachedResponse(url, 200, body, record['encoding'], from_cache=True)
+
+            body = await response.read()
+            encoding = response.get_encoding()
+
+            if response.status == 200:
+                self.cache.put(
+                    url, body, encoding,
+                    etag=response.headers.get('ETag'),
+                    last_modified=response.headers.get('Last-Modified')
+                )
+
+            return CachedResponse(url, response.status, body, encoding, from_cache=False)
+
+
+class _CachedRequest:
+    """
+    `async with session.get(...) as response` for CachedSession
+    """
+
+    def __init__(self, cached_session, url, kwargs):
+        self.cached_session = cached_session
+        self.url = url
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        return await self.cached_session.fetch(self.url, **self.kwargs)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
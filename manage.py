@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import os
+
 from migrate.versioning.shell import main
 
 if __name__ == '__main__':
-    main(repository='repository', url='sqlite:///tophealth.db', debug='False')
+    main(repository='repository', url=os.environ.get('TOPHEALTH_DATABASE_URL', 'sqlite:///tophealth.db'), debug='False')
@@ -0,0 +1,161 @@
+import math
+import re
+import unicodedata
+
+# Minimal confidence of a match: "Smile Dental" ~ "Smiles Dental" (0.89) are different businesses
+MIN_CONFIDENCE = 0.9
+
+# Minimal lead of a match over the runner-up candidate, closer matches are ambiguous
+MIN_MARGIN = 0.05
+
+# Words that do not tell facilities apart
+STOP_WORDS = {'the', 'and', 'inc', 'llc', 'ltd', 'pc', 'co', 'corp'}
+
+# Spelling variants of the same word
+SYNONYMS = {'centre': 'center', 'ctr': 'center'}
+
+
+def normalize(name):
+    """
+    :param name: Название клиники ("Dr. Smith's Dental & Co")
+    :return: Название без регистра, диакритики, пунктуации и служебных слов ("dr smiths dental"),
+        варианты написания приведены к одному ("centre" -> "center")
+    """
+
+    name = unicodedata.normalize('NFKD', name)
+    name = ''.join(char for char in name if not unicodedata.combining(char)).lower()
+    name = re.sub(r"['’`]", '', name.replace('&', ' and '))
+    return ' '.join(
+        SYNONYMS.get(token, token) for token in re.findall(r'\w+', name) if token not in STOP_WORDS
+    )
+
+
+def trigrams(normalized):
+    """
+    :return: Триграммы слов названия, как в pg_trgm ("  d", " dr", "dr ")
+    """
+
+    grams = set()
+    for token in normalized.split():
+        padded = '  ' + token + ' '
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+class NameIndex:
+    """
+    Facility names of a city indexed by normalized name and by trigram. A lookup scores only the names
+    sharing a rare trigram with the query, the confidence is the Dice coefficient of the trigram sets
+    (1.0 for equal normalized names).
+    """
+
+    def __init__(self, names=()):
+        """
+        :param names: [(key, name), ...] key - идентификатор клиники или сама запись
+        """
+
+        self.__keys = []
+        self.__grams = []
+        self.__exact = {}
+        self.__postings = {}
+
+        for key, name in names:
+            self.add(key, name)
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def add(self, key, name):
+        normalized = normalize(name)
+        grams = trigrams(normalized)
+
+        position = len(self.__keys)
+        self.__keys.append(key)
+        self.__grams.append(grams)
+        self.__exact.setdefault(normalized, []).append(position)
+        for gram in grams:
+            self.__postings.setdefault(gram, []).append(position)
+
+    def candidates(self, name, min_confidence=MIN_CONFIDENCE):
+        """
+        :return: [(key, confidence), ...] по убыванию confidence
+        """
+
+        normalized = normalize(name)
+        exact = self.__exact.get(normalized, [])
+        if len(exact) > 0:
+            return [(self.__keys[position], 1.0) for position in exact]
+
+        grams = trigrams(normalized)
+        if len(grams) == 0:
+            return []
+
+        # A name reaching min_confidence shares at least `required` trigrams with the query, so it shares
+        # one of the len(grams) - required + 1 rarest ones: only their postings are scanned (prefix filter)
+        required = max(1, math.ceil(min_confidence * len(grams) / (2 - min_confidence) - 1e-9))
+        rarest = sorted(grams, key=lambda gram: len(self.__postings.get(gram, ())))[:len(grams) - required + 1]
+
+        positions = set()
+        for gram in rarest:
+            positions.update(self.__postings.get(gram, ()))
+
+        scored = []
+        for position in positions:
+            count = len(grams & self.__grams[position])
+            confidence = 2 * count / (len(grams) + len(self.__grams[position]))
+            if confidence >= min_confidence:
+                scored.append((confidence, position))
+
+        scored.sort(key=lambda item: (-item[0], item[1]))
+        return [(self.__keys[position], confidence) for confidence, position in scored]
+
+    def match(self, name, min_confidence=MIN_CONFIDENCE, min_margin=MIN_MARGIN):
+        """
+        :return: (key, confidence) лучшего совпадения или None, если совпадение не найдено или неоднозначно
+            (второй кандидат ближе, чем на min_margin)
+        """
+
+        candidates = self.candidates(name, min_confidence - min_margin)
+        if len(candidates) == 0 or candidates[0][1] < min_confidence:
+            return None
+        if len(candidates) > 1 and candidates[0][1] - candidates[1][1] < min_margin:
+            return None
+        return candidates[0]
+
+
+def match_listing(facilities, clinics, min_confidence=MIN_CONFIDENCE, min_margin=MIN_MARGIN):
+    """
+    Matches the entries of a listing page to facilities. A pair is matched when it reaches `min_confidence`
+    and leads by `min_margin` both the other facilities of the entry and the other entries of the facility,
+    ambiguous entries and facilities stay unmatched.
+
+    :param facilities: [{id, name}, ...] клиники города
+    :param clinics: [{name, ...}, ...] записи страницы источника
+    :return: [(facility, clinic, confidence), ...]
+    """
+
+    index = NameIndex((position, facility['name']) for position, facility in enumerate(facilities))
+    candidates = [index.candidates(clinic['name'], min_confidence - min_margin) for clinic in clinics]
+
+    facility_confidences = {}
+    for clinic_candidates in candidates:
+        for facility_position, confidence in clinic_candidates:
+            facility_confidences.setdefault(facility_position, []).append(confidence)
+
+    matches = []
+    for clinic_position, clinic_candidates in enumerate(candidates):
+        if len(clinic_candidates) == 0:
+            continue
+
+        facility_position, confidence = clinic_candidates[0]
+        if confidence < min_confidence:
+            continue
+
+        # The next facility of the entry and the next entry of the facility
+        runners_up = [runner_up for _, runner_up in clinic_candidates[1:2]]
+        runners_up += sorted(facility_confidences[facility_position], reverse=True)[1:2]
+        if any(confidence - runner_up < min_margin for runner_up in runners_up):
+            continue
+
+        matches.append((facilities[facility_position], clinics[clinic_position], confidence))
+    return matches
@@ -1,18 +1,34 @@
 import asyncio
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 
 from sqlalchemy import Column, Sequence, Integer, String, ForeignKey, Text, Float, UniqueConstraint, Table, DateTime
+from sqlalchemy import Index, func
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Insert
+
+DATABASE_URL = os.environ.get('TOPHEALTH_DATABASE_URL', 'sqlite:///tophealth.db')
+DATABASE_POOL_SIZE = int(os.environ.get('TOPHEALTH_DATABASE_POOL_SIZE', '5'))
+
+# INSERT … ON CONFLICT of the upserts appeared in SQLite 3.24
+SQLITE_MIN_VERSION = (3, 24, 0)
 
 Model = declarative_base()
 
 
 facility_category = Table(
     'facility_category', Model.metadata,
-    Column('facility_id', Integer, ForeignKey('facility.id')),
-    Column('category_id', Integer, ForeignKey('category.id'))
+    Column('facility_id', Integer, ForeignKey('facility.id'), primary_key=True),
+    Column('category_id', Integer, ForeignKey('category.id'), primary_key=True),
+
+    Index('ix_facility_category_category', 'category_id', 'facility_id'),
 )
 
 
@@ -92,6 +108,8 @@ class Facility(Model):
     __tablename__ = 'facility'
     __table_args__ = (
         UniqueConstraint('name', 'city_id', name='facility_uc'),
+        # Keyset order of the review planner pages
+        Index('ix_facility_city_id', 'city_id', 'id'),
     )
 
     id = Column(Integer, Sequence('facility_id_seq'), primary_key=True)
@@ -106,8 +124,17 @@ class Facility(Model):
     reviews = relationship("Review", back_populates="facility")
 
 
+# The same clinic from several sources differs in the case of the name, the upserts use the index as conflict target
+Index('ix_facility_city_name_lower', Facility.city_id, func.lower(Facility.name), unique=True)
+
+
 class FacilityInfo(Model):
     __tablename__ = 'facility_info'
+    __table_args__ = (
+        UniqueConstraint('facility_id', 'source', name='facility_info_uc'),
+        Index('ix_facility_info_facility_source_date', 'facility_id', 'source', 'fetch_date'),
+        Index('ix_facility_info_source_page_url', 'source', 'page_url', 'fetch_date'),
+    )
 
     id = Column(Integer, Sequence('facility_info_id_seq'), primary_key=True)
 
@@ -124,12 +151,40 @@ class FacilityInfo(Model):
     fetch_date = Column(DateTime, nullable=False)
 
     source = Column(String(32))
+    page_url = Column(Text)
+
+
+class FacilityInfoHistory(Model):
+    """
+    Every fetch of facility_info. facility_info keeps only the latest fetch per source.
+    """
+
+    __tablename__ = 'facility_info_history'
+    __table_args__ = (
+        Index('ix_facility_info_history_fetch_date', 'fetch_date'),
+    )
+
+    id = Column(Integer, Sequence('facility_info_history_id_seq'), primary_key=True)
+
+    about = Column(Text)
+    phone = Column(String(32))
+    address = Column(Text, nullable=False)
+
+    image_url = Column(Text)
+    website_url = Column(Text)
+
+    facility_id = Column(Integer, ForeignKey('facility.id'), nullable=False)
+    fetch_date = Column(DateTime, nullable=False)
+
+    source = Column(String(32))
+    page_url = Column(Text)
 
 
 class Review(Model):
     __tablename__ = 'review'
     __table_args__ = (
         UniqueConstraint('facility_id', 'source', name='review_uc'),
+        Index('ix_review_facility_rating', 'facility_id', 'rating', 'count'),
     )
 
     id = Column(Integer, Sequence('review_id_seq'), primary_key=True)
@@ -137,25 +192,209 @@ class Review(Model):
     rating = Column(Float(asdecimal=True), nullable=False)
     count = Column(Integer, nullable=False, default=1)
     facility_id = Column(Integer, ForeignKey("facility.id"))
+    fetch_date = Column(DateTime)
 
     facility = relationship("Facility", back_populates="reviews")
 
 
-class AsyncSession:
-    __session_engine = create_engine('sqlite:///tophealth.db')
-    __session_maker = sessionmaker(bind=__session_engine)
-    __session = __session_maker()
-    __semaphore = asyncio.Semaphore()
+class DataVersion(Model):
+    """
+    Counter bumped after the writes of scraped data (once per flush), used to invalidate cached pages
+    """
+
+    __tablename__ = 'data_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class CrawlShard(Model):
+    """
+    A part of a sharded crawl (mode, source, city) claimed by one worker at a time
+    """
+
+    __tablename__ = 'crawl_shard'
+    __table_args__ = (
+        UniqueConstraint('run', 'mode', 'source', 'city_id', name='crawl_shard_uc'),
+        Index('ix_crawl_shard_run_status', 'run', 'status', 'heartbeat'),
+    )
+
+    id = Column(Integer, Sequence('crawl_shard_id_seq'), primary_key=True)
+    run = Column(String(64), nullable=False)
+    mode = Column(String(16), nullable=False)
+    source = Column(String(32), nullable=False)
+    city_id = Column(Integer, ForeignKey('city.id'), nullable=False)
 
-    async def __enter(self, *args, **kwargs):
-        await self.__semaphore.__aenter__(*args, **kwargs)
-        return self.__session
+    # JSON: {country, region, city, services}
+    params = Column(Text, nullable=False)
 
-    def __aenter__(self):
-        return self.__enter()
+    # pending, claimed, done
+    status = Column(String(16), nullable=False, default='pending')
+    worker = Column(String(128))
+    heartbeat = Column(DateTime)
+    claims = Column(Integer, nullable=False, default=0)
 
-    async def __leave(self, *args, **kwargs):
-        await self.__semaphore.__aexit__(*args, **kwargs)
 
-    def __aexit__(self, *args, **kwargs):
-        return self.__leave(*args, **kwargs)
+def bump_data_version(session):
+    table = DataVersion.__table__
+    result = session.execute(table.update().where(table.c.id == 1).values(version=table.c.version + 1))
+    if result.rowcount == 0:
+        session.execute(table.insert().values(id=1, version=1))
+
+
+def get_data_version(session):
+    version = session.query(DataVersion.version).filter(DataVersion.id == 1).scalar()
+    return version or 0
+
+
+class SQLiteUpsert(Insert):
+    """
+    INSERT … ON CONFLICT for SQLite (3.24+), which has no native construct in SQLAlchemy
+    """
+
+    def __init__(self, table, index_elements, update_columns):
+        super().__init__(table)
+        self.index_elements = index_elements
+        self.update_columns = update_columns
+
+
+@compiles(SQLiteUpsert, 'sqlite')
+def compile_sqlite_upsert(insert, compiler, **kwargs):
+    quote = compiler.preparer.quote
+    statement = compiler.visit_insert(insert, **kwargs)
+    statement += ' ON CONFLICT ({})'.format(', '.join(
+        # Expressions of an index on expressions (lower(name)) are rendered without the table name
+        quote(column) if isinstance(column, str) else compiler.process(column, include_table=False)
+        for column in insert.index_elements
+    ))
+
+    if len(insert.update_columns) == 0:
+        return statement + ' DO NOTHING'
+
+    return statement + ' DO UPDATE SET {}'.format(', '.join(
+        f'{quote(column)} = excluded.{quote(column)}' for column in insert.update_columns
+    ))
+
+
+def upsert(dialect, table, index_elements, update_columns=()):
+    """
+    Dialect-native upsert statement
+
+    :param dialect: Название диалекта ("sqlite", "postgresql")
+    :param table: Таблица
+    :param index_elements: Колонки или выражения уникального индекса (["facility_id", "source"])
+    :param update_columns: Колонки, обновляемые при конфликте. Если пусто - DO NOTHING
+    """
+
+    if dialect == 'postgresql':
+        statement = postgresql.insert(table)
+        if len(update_columns) == 0:
+            return statement.on_conflict_do_nothing(index_elements=index_elements)
+
+        return statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={column: statement.excluded[column] for column in update_columns}
+        )
+
+    if dialect == 'sqlite':
+        return SQLiteUpsert(table, index_elements, update_columns)
+
+    raise NotImplementedError(f"Upsert is not supported by {dialect}")
+
+
+class Database:
+    """
+    Synchronous SQLAlchemy engine whose blocking calls run on a thread pool,
+    so the event loop keeps serving network I/O while queries are executed.
+    """
+
+    def __init__(self, url=DATABASE_URL, pool_size=DATABASE_POOL_SIZE):
+        self.url = make_url(url)
+        self.pool_size = pool_size
+
+        if self.url.get_backend_name() == 'sqlite':
+            if sqlite3.sqlite_version_info < SQLITE_MIN_VERSION:
+                raise RuntimeError(
+                    f"SQLite {sqlite3.sqlite_version} is not supported, the upserts need SQLite "
+                    f"{'.'.join(map(str, SQLITE_MIN_VERSION))} or newer (or use PostgreSQL)"
+                )
+
+            # SQLite connections are opened per session and used from the executor threads
+            self.engine = create_engine(self.url, connect_args={'check_same_thread': False, 'timeout': 30})
+        else:
+            self.engine = create_engine(self.url, pool_size=pool_size, max_overflow=0)
+
+        self.session_maker = sessionmaker(bind=self.engine)
+        self.__executor = ThreadPoolExecutor(max_workers=pool_size)
+        self.__semaphore = None
+
+    @property
+    def semaphore(self):
+        # Created lazily to bind to the running event loop
+        if self.__semaphore is None:
+            self.__semaphore = asyncio.Semaphore(self.pool_size)
+        return self.__semaphore
+
+    def run(self, function, *args):
+        return asyncio.get_event_loop().run_in_executor(self.__executor, function, *args)
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+        self.engine.dispose()
+
+
+__database = None
+
+
+def configure(url=None, pool_size=None):
+    """
+    :param url: URL движка ("sqlite:///tophealth.db", "postgresql://user@localhost/tophealth")
+    :param pool_size: Количество одновременно открытых сессий
+    """
+    global __database
+    if __database is not None:
+        __database.close()
+
+    __database = Database(
+        url=url if url is not None else DATABASE_URL,
+        pool_size=pool_size if pool_size is not None else DATABASE_POOL_SIZE
+    )
+    return __database
+
+
+def get_database():
+    if __database is None:
+        return configure()
+    return __database
+
+
+class AsyncSession:
+    """
+    Per-task session. Up to `pool_size` sessions are open at the same time,
+    the work itself is passed to `run` and executed on the database thread pool:
+
+        async with AsyncSession() as session:
+            facilities = await session.run(lambda s: s.query(Facility).all())
+    """
+
+    def __init__(self, database=None):
+        self.__database = database if database is not None else get_database()
+        self.__session = None
+
+    async def __aenter__(self):
+        await self.__database.semaphore.acquire()
+        self.__session = self.__database.session_maker()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            await self.__database.run(self.__session.close)
+        finally:
+            self.__session = None
+            self.__database.semaphore.release()
+
+    def run(self, function, *args):
+        """
+        Calls `function(session, *args)` on the database thread pool
+        """
+        return self.__database.run(function, self.__session, *args)
@@ -0,0 +1,92 @@
+import collections
+import hashlib
+import time
+
+import aiohttp_jinja2
+from aiohttp import web
+
+import models
+
+
+CacheEntry = collections.namedtuple('CacheEntry', ['version', 'expires', 'body', 'etag'])
+
+
+class PageCache:
+    """
+    LRU cache of rendered pages. Entries expire after `ttl` seconds or as soon as the data version
+    (bumped after every ScraperAPI flush) changes. The version is read at most once per `version_ttl` seconds.
+    """
+
+    def __init__(self, max_entries=256, ttl=300, version_ttl=1.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+
+        self.__entries = collections.OrderedDict()
+        self.__version = None
+        self.__version_expires = 0
+
+    async def version(self):
+        now = time.monotonic()
+        if self.__version is None or now >= self.__version_expires:
+            async with models.AsyncSession() as session:
+                self.__version = await session.run(models.get_data_version)
+            self.__version_expires = now + self.version_ttl
+        return self.__version
+
+    def get(self, key, version):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return None
+
+        if entry.version != version or time.monotonic() >= entry.expires:
+            del self.__entries[key]
+            return None
+
+        self.__entries.move_to_end(key)
+        return entry
+
+    def put(self, key, version, body):
+        entry = CacheEntry(
+            version=version,
+            expires=time.monotonic() + self.ttl,
+            body=body,
+            etag='"{}"'.format(hashlib.sha1(body.encode('utf-8')).hexdigest())
+        )
+
+        self.__entries[key] = entry
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+        return entry
+
+    def invalidate(self):
+        self.__entries.clear()
+        self.__version = None
+
+    async def render(self, request, key, template_name, get_context):
+        """
+        :param key: Ключ страницы (("top", "ON", "Toronto", "Dentists", 50, 0))
+        :param template_name: Шаблон ("tophealth.html")
+        :param get_context: Корутина, возвращающая контекст шаблона. Вызывается только при промахе кэша
+        :return: web.Response с ETag, 304 если совпал If-None-Match
+        """
+
+        version = await self.version()
+        entry = self.get(key, version)
+        if entry is None:
+            context = await get_context()
+            entry = self.put(key, version, aiohttp_jinja2.render_string(template_name, request, context))
+
+        headers = {
+            'ETag': entry.etag,
+            'Cache-Control': 'no-cache',
+        }
+
+        # Weak comparison: W/"..." matches "..."
+        if_none_match = [etag.strip().replace('W/', '', 1) for etag in request.headers.get('If-None-Match', '').split(',')]
+        if entry.etag in if_none_match or '*' in if_none_match:
+            return web.Response(status=304, headers=headers)
+
+        return web.Response(text=entry.body, content_type='text/html', headers=headers)
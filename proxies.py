@@ -1,16 +1,309 @@
 import asyncio
+import json
+import os
 import random
+import time
 
 import proxybroker
 
 
-class AsyncProxyFinder:
+class WeightedSampler:
+    """
+    Weighted random choice of keys in O(log n): a Fenwick tree over the weights of key slots.
+    Slots of removed keys are reused, the tree is rebuilt from the weights now and then
+    to drop the accumulated floating point error.
+    """
+
     def __init__(self):
+        self.__tree = [0.0]
+        self.__weights = []
+        self.__keys = []
+        self.__slots = {}
+        self.__free_slots = []
+        self.__updates = 0
+
+    def __len__(self):
+        return len(self.__slots)
+
+    def __contains__(self, key):
+        return key in self.__slots
+
+    def __add(self, index, delta):
+        while index < len(self.__tree):
+            self.__tree[index] += delta
+            index += index & -index
+
+    def __prefix(self, index):
+        total = 0.0
+        while index > 0:
+            total += self.__tree[index]
+            index -= index & -index
+        return total
+
+    def __rebuild(self):
+        self.__tree = [0.0] + list(self.__weights)
+        for index in range(1, len(self.__tree)):
+            parent = index + (index & -index)
+            if parent < len(self.__tree):
+                self.__tree[parent] += self.__tree[index]
+        self.__updates = 0
+
+    @property
+    def total(self):
+        return self.__prefix(len(self.__weights))
+
+    def weight(self, key):
+        slot = self.__slots.get(key)
+        return 0.0 if slot is None else self.__weights[slot]
+
+    def set(self, key, weight):
+        slot = self.__slots.get(key)
+        if slot is None:
+            if len(self.__free_slots) > 0:
+                slot = self.__free_slots.pop()
+            else:
+                slot = len(self.__weights)
+                self.__weights.append(0.0)
+                self.__keys.append(None)
+                # The node of a new slot covers the weights of the slots before it
+                index = slot + 1
+                self.__tree.append(self.__prefix(index - 1) - self.__prefix(index - (index & -index)))
+
+            self.__slots[key] = slot
+            self.__keys[slot] = key
+
+        self.__add(slot + 1, weight - self.__weights[slot])
+        self.__weights[slot] = weight
+
+        self.__updates += 1
+        if self.__updates > 4 * len(self.__weights) + 16:
+            self.__rebuild()
+
+    def remove(self, key):
+        slot = self.__slots.pop(key, None)
+        if slot is None:
+            return
+
+        self.__add(slot + 1, -self.__weights[slot])
+        self.__weights[slot] = 0.0
+        self.__keys[slot] = None
+        self.__free_slots.append(slot)
+
+    def sample(self):
+        """
+        :return: Ключ с вероятностью, пропорциональной весу, или None, если все веса нулевые
+        """
+
+        total = self.total
+        if total <= 0:
+            return None
+
+        # Descend the tree to the first slot whose prefix sum exceeds the target
+        target = random.random() * total
+        position = 0
+        step = 1 << (len(self.__weights).bit_length() - 1)
+        while step > 0:
+            index = position + step
+            if index < len(self.__tree) and self.__tree[index] <= target:
+                position = index
+                target -= self.__tree[index]
+            step >>= 1
+
+        position = min(position, len(self.__weights) - 1)
+        if self.__weights[position] <= 0:
+            # Rounding error of the tree, pick the heaviest key instead
+            position = max(range(len(self.__weights)), key=self.__weights.__getitem__)
+        return self.__keys[position]
+
+
+class ProxyHealth:
+    """
+    Statistics of a proxy: success ratio, latency EWMA and a cool-down after consecutive failures
+    """
+
+    # Seconds, latency of a proxy without measurements and the floor of the measured ones
+    default_latency = 5.0
+    min_latency = 0.5
+    # Weight of a new latency measurement
+    alpha = 0.3
+
+    cooldown = 5
+    cooldown_max = 300
+
+    def __init__(self, latency=None):
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = latency if latency is not None else self.default_latency
+        self.cooldown_until = 0
+        self.last_seen = time.time()
+
+    @property
+    def count(self):
+        return self.successes + self.failures
+
+    @property
+    def success_ratio(self):
+        # Smoothed, a new proxy starts at 1/2
+        return (self.successes + 1) / (self.count + 2)
+
+    @property
+    def weight(self):
+        """
+        Expected successful requests per second through the proxy, zero while it cools down
+        """
+
+        if self.cooldown_until > time.monotonic():
+            return 0.0
+        return self.success_ratio / max(self.latency, self.min_latency)
+
+    def report(self, failed, latency=None):
+        """
+        :return: Секунды остывания после ошибки или 0
+        """
+
+        self.last_seen = time.time()
+        if latency is not None:
+            self.latency += self.alpha * (latency - self.latency)
+
+        if not failed:
+            self.successes += 1
+            self.consecutive_failures = 0
+            return 0
+
+        self.failures += 1
+        self.consecutive_failures += 1
+        cooldown = min(self.cooldown * 2 ** (self.consecutive_failures - 1), self.cooldown_max)
+        self.cooldown_until = time.monotonic() + cooldown
+        return cooldown
+
+
+class ProxyStore:
+    """
+    Proxy statistics kept between runs in a JSON file:
+
+        {"http://1.2.3.4:8080": {"successes": 12, "failures": 1, "latency": 0.8, "last_seen": 1536000000.0},
+         "http://5.6.7.8:3128": {"dead": true, "last_seen": 1536000000.0}}
+
+    Counts loaded from the file are halved every `half_life` seconds of age, so old measurements
+    weigh less than new ones. Dead proxies get another chance after `dead_ttl`, proxies not seen
+    for `max_age` are forgotten.
+    """
+
+    half_life = 6 * 3600
+    dead_ttl = 24 * 3600
+    max_age = 7 * 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        """
+        :return: ({proxy address: ProxyHealth}, {dead proxy address: last seen})
+        """
+
+        if not os.path.exists(self.path):
+            return {}, {}
+
+        try:
+            with open(self.path) as f:
+                records = json.load(f)
+        except ValueError:
+            print(f"<!> Proxy store {self.path} is damaged, starting without it")
+            return {}, {}
+
+        work_proxies = {}
+        dead_proxies = {}
+        now = time.time()
+        for proxy_address, record in records.items():
+            age = max(now - record['last_seen'], 0)
+            if age > self.max_age:
+                continue
+
+            if record.get('dead'):
+                if age < self.dead_ttl:
+                    dead_proxies[proxy_address] = record['last_seen']
+                continue
+
+            decay = 0.5 ** (age / self.half_life)
+            health = work_proxies[proxy_address] = ProxyHealth(record['latency'])
+            health.successes = record['successes'] * decay
+            health.failures = record['failures'] * decay
+            health.last_seen = record['last_seen']
+
+        return work_proxies, dead_proxies
+
+    def save(self, work_proxies, dead_proxies):
+        records = {
+            proxy_address: {
+                'successes': health.successes,
+                'failures': health.failures,
+                'latency': health.latency,
+                'last_seen': health.last_seen,
+            }
+            for proxy_address, health in work_proxies.items()
+        }
+        records.update({
+            proxy_address: {'dead': True, 'last_seen': last_seen}
+            for proxy_address, last_seen in dead_proxies.items()
+        })
+
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(records, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class AsyncProxyFinder:
+    """
+    Pool of proxies found by proxybroker. `get` picks a proxy with the probability proportional
+    to its health weight (success ratio / latency), failing proxies cool down and dead ones are dropped.
+
+    Waiting workers are woken by an event as soon as a proxy is added or restored, the broker is
+    restarted when the number of usable proxies falls to the low watermark.
+    """
+
+    # Seconds without a found proxy before the broker is considered stuck
+    broker_timeout = 20
+
+    def __init__(self, min_count=10, store: ProxyStore = None):
+        self.min_count = min_count
+        self.store = store
         self.__work_proxies = dict()
-        self.__dead_proxies = set()
+        self.__sampler = WeightedSampler()
+        self.__dead_proxies = dict()
         self.__proxies = asyncio.Queue()
         self.__broker = None
         self.__task = None
+        self.__available = None
+        self.__refill = None
+
+        # Workers start on the proxies known from the previous runs
+        if store is not None:
+            self.__work_proxies, self.__dead_proxies = store.load()
+            for proxy_address, health in self.__work_proxies.items():
+                self.__sampler.set(proxy_address, health.weight)
+            if len(self.__work_proxies) > 0:
+                print(f"Loaded {len(self.__work_proxies)} proxies from {store.path}")
+
+    @property
+    def available(self):
+        # Created lazily to bind to the running event loop
+        if self.__available is None:
+            self.__available = asyncio.Event()
+        return self.__available
+
+    @property
+    def refill(self):
+        if self.__refill is None:
+            self.__refill = asyncio.Event()
+        return self.__refill
+
+    def usable_count(self):
+        return sum(1 for health in self.__work_proxies.values() if health.weight > 0)
+
+    def __check_watermark(self):
+        if self.usable_count() <= self.min_count:
+            self.refill.set()
 
     async def run_proxy_broker(self, limit):
         if self.__broker is not None:
@@ -18,6 +311,7 @@ class AsyncProxyFinder:
             self.__broker.stop()
 
         self.__broker = proxybroker.Broker(self.__proxies)
+        self.refill.clear()
 
         # ---- PROXYBROKER BUG BYPASS ----
         from proxybroker import resolver
@@ -28,57 +322,88 @@ class AsyncProxyFinder:
         print(f"Fetching proxies({proxy_count}/{limit})...")
         asyncio.ensure_future(self.__broker.find(types=['HTTP'], limit=limit))
 
-    async def update_proxies(self, min_count=10):
-        await self.run_proxy_broker(min_count * 2)
+    async def update_proxies(self, min_count=None):
+        if min_count is not None:
+            self.min_count = min_count
+
+        await self.run_proxy_broker(self.min_count * 2)
         while True:
             try:
-                need_to_restart_broker = True
-                for _ in range(2):
-                    if self.__proxies.empty():
-                        await asyncio.sleep(10)
-                    else:
-                        need_to_restart_broker = False
-                        break
-
-                if need_to_restart_broker:
-                    print("Proxies query is empty!")
-                    await self.run_proxy_broker(min_count * 2)
-                else:
-                    proxy = await self.__proxies.get()
-                    if proxy is None:
-                        while len(self.__work_proxies) > min_count:
-                            await asyncio.sleep(10)
+                try:
+                    proxy = await asyncio.wait_for(self.__proxies.get(), timeout=self.broker_timeout)
+                except asyncio.TimeoutError:
+                    # A stuck broker is restarted only while the pool is short of proxies
+                    if self.usable_count() <= self.min_count:
+                        print("Proxies query is empty!")
+                        await self.run_proxy_broker(self.min_count * 2)
+                    continue
 
-                        await self.run_proxy_broker(min_count * 2)
-                    else:
-                        proxy_address = f'http://{proxy.host}:{proxy.port}'
-                        if proxy_address not in self.__work_proxies:
-                            await self.report(proxy_address, failed=False)
+                if proxy is None:
+                    # The broker found its limit, the next search starts at the low watermark
+                    self.__check_watermark()
+                    await self.refill.wait()
+                    await self.run_proxy_broker(self.min_count * 2)
+                else:
+                    proxy_address = f'http://{proxy.host}:{proxy.port}'
+                    self.add(proxy_address, latency=proxy.avg_resp_time or None)
 
             except Exception as ex:
-                await self.run_proxy_broker(min_count * 2)
+                await self.run_proxy_broker(self.min_count * 2)
                 print(ex)
 
+    def save(self):
+        if self.store is not None:
+            self.store.save(self.__work_proxies, self.__dead_proxies)
+
+    def add(self, proxy_address, latency=None):
+        if proxy_address in self.__work_proxies or proxy_address in self.__dead_proxies:
+            return
+
+        health = self.__work_proxies[proxy_address] = ProxyHealth(latency)
+        self.__sampler.set(proxy_address, health.weight)
+        self.available.set()
+
     async def get(self):
         while True:
-            try:
-                proxy_address, = random.sample(self.__work_proxies.keys(), 1)
+            proxy_address = self.__sampler.sample()
+            if proxy_address is not None:
                 return proxy_address
-            except ValueError:
-                await asyncio.sleep(10)
-                while len(self.__work_proxies) == 0:
-                    await asyncio.sleep(10)
 
-    async def report(self, proxy_address, failed: bool):
+            # Every proxy is dead or cooling down
+            self.available.clear()
+            self.__check_watermark()
+            await self.available.wait()
+
+    def __restore(self, proxy_address):
+        health = self.__work_proxies.get(proxy_address)
+        if health is not None and health.weight > 0:
+            self.__sampler.set(proxy_address, health.weight)
+            self.available.set()
+
+    async def report(self, proxy_address, failed: bool, latency=None):
+        """
+        :param latency: Секунды выполнения запроса через прокси
+        """
+
         if proxy_address in self.__dead_proxies:
             return
 
-        cumulative, count = self.__work_proxies.get(proxy_address, (0, 0))
-        cumulative += 1 if not failed else -1
-        count += 1
+        health = self.__work_proxies.get(proxy_address)
+        if health is None:
+            health = self.__work_proxies[proxy_address] = ProxyHealth()
 
-        self.__work_proxies[proxy_address] = (cumulative, count)
-        if failed and count > 10 and (cumulative / count) < 0.5:
+        cooldown = health.report(failed, latency)
+        if failed and health.count > 10 and health.successes / health.count < 0.5:
             print(f"<!> Dead proxy {proxy_address}")
             del self.__work_proxies[proxy_address]
-            self.__dead_proxies.add(proxy_address)
+            self.__sampler.remove(proxy_address)
+            self.__dead_proxies[proxy_address] = time.time()
+            self.__check_watermark()
+            return
+
+        self.__sampler.set(proxy_address, health.weight)
+        if cooldown > 0:
+            asyncio.get_event_loop().call_later(cooldown, self.__restore, proxy_address)
+            self.__check_watermark()
+        elif health.weight > 0:
+            self.available.set()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+"""
+Checks that the hot queries of the site and the scrapers are answered with index scans.
+
+    TOPHEALTH_DATABASE_URL=postgresql://localhost/tophealth python query_plans.py
+
+The database must be upgraded to the latest schema version. Exits with a non-zero status
+when a table of a hot query is read with a full scan.
+"""
+import datetime
+import json
+import re
+import sys
+
+import sqlalchemy.orm
+
+import api_client
+import app
+import models
+
+
+def hot_queries(session):
+    """
+    :return: [(name, query, [tables which must be read through an index]), ...]
+    """
+
+    return [
+        (
+            'top list (app.generate_result)',
+            app.top_facilities_query(session, 'Toronto', 'ON', None, ['Dentists']).limit(51),
+            ['facility', 'facility_info', 'facility_category', 'review']
+        ),
+        (
+            'facilities of a city and a service (ScraperAPI.get_facilities)',
+            session.query(models.Facility).join(models.Facility.categories).filter(
+                models.Facility.city_id == 1,
+                models.Category.id == 1
+            ),
+            ['facility', 'facility_category']
+        ),
+        (
+            'facility info of a source (facility_info upsert and freshness checks)',
+            session.query(models.FacilityInfo.id, models.FacilityInfo.fetch_date).filter(
+                models.FacilityInfo.facility_id == 1,
+                models.FacilityInfo.source == 'yelp'
+            ),
+            ['facility_info']
+        ),
+        (
+            'fresh pages of a source (ScraperAPI.get_fresh_pages)',
+            session.query(models.FacilityInfo.page_url).filter(
+                models.FacilityInfo.source == 'yelp',
+                models.FacilityInfo.page_url.in_(['https://www.yelp.com/biz/back-in-balance-clinic-toronto']),
+                models.FacilityInfo.fetch_date >= datetime.datetime(2018, 1, 1)
+            ),
+            ['facility_info']
+        ),
+        (
+            'reviews of a facility',
+            session.query(models.Review).filter(models.Review.facility_id == 1),
+            ['review']
+        ),
+        (
+            'facility ids by case-folded names (ScraperAPI facility upserts)',
+            api_client.facility_ids_query(session, 1, ['Back In Balance Clinic', 'back in balance clinic']),
+            ['facility']
+        ),
+        (
+            'keyset page of the review planner (ScraperAPI.get_facility_page)',
+            api_client.facility_page_query([1, 2], after=(1, 1)),
+            # SQLite plans name the aliases of the page subquery
+            ['facility', 'facility_category', 'page', 'page_category']
+        ),
+        (
+            'facility info history retention',
+            session.query(models.FacilityInfoHistory.id).filter(
+                models.FacilityInfoHistory.fetch_date < datetime.datetime(2018, 1, 1)
+            ),
+            ['facility_info_history']
+        ),
+    ]
+
+
+def compile_query(session, query):
+    if isinstance(query, sqlalchemy.orm.Query):
+        query = query.statement
+    return str(query.compile(dialect=session.bind.dialect, compile_kwargs={'literal_binds': True}))
+
+
+def sqlite_full_scans(session, query, tables):
+    full_scans = []
+    for _, _, _, detail in session.execute('EXPLAIN QUERY PLAN ' + compile_query(session, query)):
+        match = re.match(r'(?:SCAN|SEARCH) (?:TABLE )?(\w+)', detail)
+        if match is None or match.group(1) not in tables:
+            continue
+
+        if 'INDEX' not in detail and 'PRIMARY KEY' not in detail:
+            full_scans.append(detail)
+    return full_scans
+
+
+def postgresql_full_scans(session, query, tables):
+    # Tiny tables are cheaper to scan, the check is whether an index can be used at all
+    session.execute('SET LOCAL enable_seqscan = off')
+    plan = session.execute('EXPLAIN (FORMAT JSON) ' + compile_query(session, query)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    full_scans = []
+    nodes = [plan[0]['Plan']]
+    while len(nodes) > 0:
+        node = nodes.pop()
+        nodes.extend(node.get('Plans', []))
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') in tables:
+            full_scans.append(f"Seq Scan on {node['Relation Name']}")
+    return full_scans
+
+
+def check_query_plans(database):
+    """
+    :return: {query name: [full scans, ...]} для запросов, не использующих индексы
+    """
+
+    explain = {
+        'sqlite': sqlite_full_scans,
+        'postgresql': postgresql_full_scans,
+    }.get(database.engine.dialect.name)
+    if explain is None:
+        raise NotImplementedError(f"Query plans are not checked for {database.engine.dialect.name}")
+
+    failures = {}
+    session = database.session_maker()
+    try:
+        for name, query, tables in hot_queries(session):
+            full_scans = explain(session, query, tables)
+            if len(full_scans) > 0:
+                failures[name] = full_scans
+    finally:
+        session.rollback()
+        session.close()
+
+    return failures
+
+
+def main():
+    database = models.get_database()
+    failures = check_query_plans(database)
+
+    for name, full_scans in failures.items():
+        print(f"<!> {name}:")
+        for full_scan in full_scans:
+            print(f"    {full_scan}")
+
+    if len(failures) > 0:
+        sys.exit(1)
+
+    print(f"All hot queries use indexes on {database.engine.dialect.name}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, slowdown=1.0):
+        """
+        Takes a token, the balance may go negative to queue the callers
+
+        :return: Задержка в секундах до использования токена
+        """
+
+        now = time.monotonic()
+        rate = self.rate / slowdown
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / rate
+
+
+class HostLimiter:
+    """
+    Politeness per host and per host × proxy.
+
+    :param limits: {
+        host: {
+            rate: Запросов в секунду к хосту (1.0)
+            burst: Запросов подряд (5)
+            proxy_rate: Запросов в секунду к хосту через один прокси (0.1)
+            proxy_burst: (1)
+        }
+    }
+
+    Every block (captcha, maintenance page) halves the host rate and puts the proxy on a cool-down
+    for the host, successful requests restore the rate gradually.
+    """
+
+    max_slowdown = 32
+    recovery = 0.9
+    proxy_cooldown = 60
+    proxy_cooldown_max = 3600
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.__hosts = {}
+        self.__proxies = {}
+        self.__slowdown = {}
+        self.__cooldowns = {}
+
+    def __bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+        return bucket
+
+    def available(self, host, proxy_address):
+        """
+        :return: False, если прокси заблокирован хостом и еще остывает
+        """
+
+        cooldown = self.__cooldowns.get((host, proxy_address))
+        return cooldown is None or cooldown[1] <= time.monotonic()
+
+    async def acquire(self, host, proxy_address):
+        limit = self.limits.get(host)
+        if limit is None:
+            return
+
+        slowdown = self.__slowdown.get(host, 1.0)
+        delay = self.__bucket(self.__hosts, host, limit['rate'], limit['burst']).reserve(slowdown)
+
+        proxy_rate = limit.get('proxy_rate')
+        if proxy_rate is not None:
+            delay = max(delay, self.__bucket(
+                self.__proxies, (host, proxy_address), proxy_rate, limit.get('proxy_burst', 1)
+            ).reserve(slowdown))
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def report(self, host, proxy_address, blocked: bool):
+        if host not in self.limits:
+            return
+
+        slowdown = self.__slowdown.get(host, 1.0)
+        if blocked:
+            self.__slowdown[host] = min(slowdown * 2, self.max_slowdown)
+
+            blocks, _ = self.__cooldowns.get((host, proxy_address), (0, 0))
+            cooldown = min(self.proxy_cooldown * 2 ** blocks, self.proxy_cooldown_max)
+            self.__cooldowns[(host, proxy_address)] = (blocks + 1, time.monotonic() + cooldown)
+            print(f"<!> {host} blocked {proxy_address}, slowdown x{self.__slowdown[host]:.1f}")
+        else:
+            self.__slowdown[host] = max(slowdown * self.recovery, 1.0)
+            self.__cooldowns.pop((host, proxy_address), None)
@@ -0,0 +1,35 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+    facility_info = Table('facility_info', meta, autoload=True)
+
+    # Keep only the latest fetch (by fetch_date, then id) for every facility and source
+    newer = facility_info.alias('newer')
+    migrate_engine.execute(facility_info.delete().where(exists(
+        select([newer.c.id]).where(and_(
+            newer.c.facility_id == facility_info.c.facility_id,
+            newer.c.source == facility_info.c.source,
+            or_(
+                newer.c.fetch_date > facility_info.c.fetch_date,
+                and_(newer.c.fetch_date == facility_info.c.fetch_date, newer.c.id > facility_info.c.id)
+            )
+        ))
+    )))
+
+    UniqueConstraint(facility_info.c.facility_id, facility_info.c.source, name='facility_info_uc').create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+    facility_info = Table('facility_info', meta, autoload=True)
+
+    UniqueConstraint(facility_info.c.facility_id, facility_info.c.source, name='facility_info_uc').drop()
@@ -0,0 +1,48 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+facility_info_history = Table(
+    'facility_info_history', meta,
+
+    Column('id', Integer, Sequence('facility_info_history_id_seq', metadata=meta), primary_key=True),
+
+    Column('facility_id', Integer, ForeignKey('facility.id'), nullable=False),
+    Column('fetch_date', DateTime, nullable=False),
+
+    Column('source', String(32)),
+
+    Column('about', Text),
+    Column('phone', String(32)),
+    Column('address', Text, nullable=False),
+
+    Column('image_url', Text),
+    Column('website_url', Text)
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+    Table('facility', meta, autoload=True)
+    facility_info = Table('facility_info', meta, autoload=True)
+
+    facility_info_history.create()
+
+    columns = ['facility_id', 'fetch_date', 'source', 'about', 'phone', 'address', 'image_url', 'website_url']
+    migrate_engine.execute(
+        facility_info_history.insert().from_select(
+            columns, select([facility_info.c[column] for column in columns])
+        )
+    )
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+    Table('facility', meta, autoload=True)
+
+    facility_info_history.drop()
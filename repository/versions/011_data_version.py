@@ -0,0 +1,28 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+data_version = Table(
+    'data_version', meta,
+
+    Column('id', Integer, primary_key=True),
+    Column('version', Integer, nullable=False, server_default='0'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+
+    data_version.create()
+    migrate_engine.execute(data_version.insert().values(id=1, version=0))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+
+    data_version.drop()
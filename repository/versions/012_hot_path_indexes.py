@@ -0,0 +1,44 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+
+def indexes():
+    city = Table('city', meta, autoload=True)
+    facility = Table('facility', meta, autoload=True)
+    facility_category = Table('facility_category', meta, autoload=True)
+    facility_info = Table('facility_info', meta, autoload=True)
+    facility_info_history = Table('facility_info_history', meta, autoload=True)
+    review = Table('review', meta, autoload=True)
+
+    return [
+        Index('ix_city_name_lower', func.lower(city.c.name)),
+        Index('ix_facility_city', facility.c.city_id, facility.c.name),
+        Index('ix_facility_city_name_lower', facility.c.city_id, func.lower(facility.c.name)),
+        Index('ix_facility_category_category', facility_category.c.category_id, facility_category.c.facility_id),
+        Index(
+            'ix_facility_info_facility_source_date',
+            facility_info.c.facility_id, facility_info.c.source, facility_info.c.fetch_date
+        ),
+        Index('ix_facility_info_history_fetch_date', facility_info_history.c.fetch_date),
+        Index('ix_review_facility_rating', review.c.facility_id, review.c.rating, review.c.count),
+    ]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+
+    for index in indexes():
+        index.create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+
+    for index in indexes():
+        index.drop(migrate_engine)
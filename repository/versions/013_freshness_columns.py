@@ -0,0 +1,42 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+    Table('facility', meta, autoload=True)
+    facility_info = Table('facility_info', meta, autoload=True)
+    facility_info_history = Table('facility_info_history', meta, autoload=True)
+    review = Table('review', meta, autoload=True)
+
+    Column('page_url', Text).create(facility_info)
+    Column('page_url', Text).create(facility_info_history)
+    Column('fetch_date', DateTime).create(review)
+
+    Index(
+        'ix_facility_info_source_page_url',
+        facility_info.c.source, facility_info.c.page_url, facility_info.c.fetch_date
+    ).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+    Table('facility', meta, autoload=True)
+    facility_info = Table('facility_info', meta, autoload=True)
+    facility_info_history = Table('facility_info_history', meta, autoload=True)
+    review = Table('review', meta, autoload=True)
+
+    index, = [index for index in facility_info.indexes if index.name == 'ix_facility_info_source_page_url']
+    index.drop(migrate_engine)
+    # SQLite recreates the table to drop a column, the dropped index must not be restored
+    facility_info.indexes.remove(index)
+
+    facility_info.c.page_url.drop()
+    facility_info_history.c.page_url.drop()
+    review.c.fetch_date.drop()
@@ -0,0 +1,42 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+crawl_shard = Table(
+    'crawl_shard', meta,
+
+    Column('id', Integer, Sequence('crawl_shard_id_seq', metadata=meta), primary_key=True),
+    Column('run', String(64), nullable=False),
+    Column('mode', String(16), nullable=False),
+    Column('source', String(32), nullable=False),
+    Column('city_id', Integer, ForeignKey('city.id'), nullable=False),
+
+    Column('params', Text, nullable=False),
+
+    Column('status', String(16), nullable=False, server_default='pending'),
+    Column('worker', String(128)),
+    Column('heartbeat', DateTime),
+    Column('claims', Integer, nullable=False, server_default='0'),
+
+    UniqueConstraint('run', 'mode', 'source', 'city_id', name='crawl_shard_uc'),
+    Index('ix_crawl_shard_run_status', 'run', 'status', 'heartbeat'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+    Table('city', meta, autoload=True)
+
+    crawl_shard.create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+    Table('city', meta, autoload=True)
+
+    crawl_shard.drop()
@@ -0,0 +1,113 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+
+def latest(first, second):
+    """
+    :return: Более свежая из двух записей (id, fetch_date), без fetch_date - самая старая
+    """
+
+    return max(first, second, key=lambda row: (row[1] is not None, row[1] or 0, row[0]))
+
+
+def merge_by_source(migrate_engine, table, duplicate_id, keeper_id):
+    """
+    Moves the rows of a (facility_id, source) unique table to the kept facility, the latest row of a source wins
+    """
+
+    kept = {
+        source: (row_id, fetch_date)
+        for row_id, source, fetch_date in migrate_engine.execute(
+            select([table.c.id, table.c.source, table.c.fetch_date]).where(table.c.facility_id == keeper_id)
+        ).fetchall()
+    }
+
+    for row_id, source, fetch_date in migrate_engine.execute(
+        select([table.c.id, table.c.source, table.c.fetch_date]).where(table.c.facility_id == duplicate_id)
+    ).fetchall():
+        if source in kept:
+            if latest(kept[source], (row_id, fetch_date)) == kept[source]:
+                migrate_engine.execute(table.delete().where(table.c.id == row_id))
+                continue
+            migrate_engine.execute(table.delete().where(table.c.id == kept[source][0]))
+
+        migrate_engine.execute(table.update().where(table.c.id == row_id).values(facility_id=keeper_id))
+
+
+def drop_name_index(migrate_engine, facility, unique):
+    Index('ix_facility_city_name_lower', facility.c.city_id, func.lower(facility.c.name), unique=unique).drop(
+        migrate_engine
+    )
+
+    # SQLite recreates the table to change the constraints, the dropped index must not be dropped again
+    for index in [index for index in facility.indexes if index.name == 'ix_facility_city_name_lower']:
+        facility.indexes.remove(index)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+    Table('city', meta, autoload=True)
+    Table('category', meta, autoload=True)
+    facility = Table('facility', meta, autoload=True)
+    facility_category = Table('facility_category', meta, autoload=True)
+    facility_info = Table('facility_info', meta, autoload=True)
+    facility_info_history = Table('facility_info_history', meta, autoload=True)
+    review = Table('review', meta, autoload=True)
+
+    # Facilities with the same name up to the case are merged into the oldest one
+    keepers = {}
+    duplicates = []
+    for facility_id, city_id, name_lower in migrate_engine.execute(
+        select([facility.c.id, facility.c.city_id, func.lower(facility.c.name)]).order_by(facility.c.id)
+    ).fetchall():
+        keeper_id = keepers.setdefault((city_id, name_lower), facility_id)
+        if keeper_id != facility_id:
+            duplicates.append((facility_id, keeper_id))
+
+    for duplicate_id, keeper_id in duplicates:
+        kept_categories = {
+            category_id for category_id, in migrate_engine.execute(
+                select([facility_category.c.category_id]).where(facility_category.c.facility_id == keeper_id)
+            ).fetchall()
+        }
+        for category_id, in migrate_engine.execute(
+            select([facility_category.c.category_id]).where(facility_category.c.facility_id == duplicate_id)
+        ).fetchall():
+            if category_id not in kept_categories:
+                migrate_engine.execute(facility_category.insert().values(facility_id=keeper_id, category_id=category_id))
+        migrate_engine.execute(facility_category.delete().where(facility_category.c.facility_id == duplicate_id))
+
+        merge_by_source(migrate_engine, facility_info, duplicate_id, keeper_id)
+        merge_by_source(migrate_engine, review, duplicate_id, keeper_id)
+        migrate_engine.execute(
+            facility_info_history.update().where(
+                facility_info_history.c.facility_id == duplicate_id
+            ).values(facility_id=keeper_id)
+        )
+
+        migrate_engine.execute(facility.delete().where(facility.c.id == duplicate_id))
+
+    drop_name_index(migrate_engine, facility, unique=False)
+    UniqueConstraint(facility.c.name, facility.c.city_id, name='facility_uc').create()
+
+    # The conflict target of the facility upserts
+    Index(
+        'ix_facility_city_name_lower', facility.c.city_id, func.lower(facility.c.name), unique=True
+    ).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+    Table('city', meta, autoload=True)
+    facility = Table('facility', meta, autoload=True)
+
+    # Merged facilities are not restored
+    drop_name_index(migrate_engine, facility, unique=True)
+    UniqueConstraint(facility.c.name, facility.c.city_id, name='facility_uc').drop()
+    Index('ix_facility_city_name_lower', facility.c.city_id, func.lower(facility.c.name)).create(migrate_engine)
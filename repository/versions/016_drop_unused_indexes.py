@@ -0,0 +1,34 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+
+def indexes():
+    city = Table('city', meta, autoload=True)
+    facility = Table('facility', meta, autoload=True)
+
+    return [
+        # Cities are resolved by the in-memory LocationResolver, no query filters on lower(city.name)
+        Index('ix_city_name_lower', func.lower(city.c.name)),
+        # Facilities are looked up through the unique (city_id, lower(name)) index
+        Index('ix_facility_city', facility.c.city_id, facility.c.name),
+    ]
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+
+    for index in indexes():
+        index.drop(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+
+    for index in indexes():
+        index.create(migrate_engine)
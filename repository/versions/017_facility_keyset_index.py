@@ -0,0 +1,25 @@
+from sqlalchemy import *
+from migrate import *
+
+
+meta = MetaData()
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    meta.bind = migrate_engine
+    Table('city', meta, autoload=True)
+    facility = Table('facility', meta, autoload=True)
+
+    # Keyset order of the review planner pages
+    Index('ix_facility_city_id', facility.c.city_id, facility.c.id).create(migrate_engine)
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    meta.bind = migrate_engine
+    Table('city', meta, autoload=True)
+    facility = Table('facility', meta, autoload=True)
+
+    Index('ix_facility_city_id', facility.c.city_id, facility.c.id).drop(migrate_engine)
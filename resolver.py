@@ -0,0 +1,142 @@
+import threading
+
+import sqlalchemy
+
+import models
+
+
+class ReferenceCache:
+    """
+    Static reference data loaded once per engine into case-folded dict indexes.
+    Loading happens on the first lookup, `invalidate` drops the indexes after the data is changed.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__engine = None
+        self.__index = None
+
+    def invalidate(self):
+        with self.__lock:
+            self.__engine = None
+            self.__index = None
+
+    def index(self, session):
+        with self.__lock:
+            if self.__index is None or self.__engine is not session.bind:
+                self.__index = self.load(session)
+                self.__engine = session.bind
+            return self.__index
+
+    def load(self, session):
+        raise NotImplementedError
+
+
+def fold(value):
+    return str.lower(value) if value is not None else None
+
+
+class LocationResolver(ReferenceCache):
+    def load(self, session):
+        location_query = session.query(
+            models.City.id, models.City.name,
+            models.Region.name, models.Region.code,
+            models.Country.name, models.Country.code,
+        ).select_from(
+            sqlalchemy.join(
+                models.City,
+                sqlalchemy.join(
+                    models.Region,
+                    models.Country,
+                    models.Region.country_id == models.Country.id
+                ),
+                models.City.region_id == models.Region.id
+            )
+        ).order_by(models.City.id)
+
+        cities = {}
+        for city_id, city_name, region_name, region_code, country_name, country_code in location_query.all():
+            cities.setdefault(fold(city_name), []).append((
+                city_id,
+                (fold(region_name), fold(region_code)),
+                (fold(country_name), fold(country_code)),
+            ))
+        return cities
+
+    def resolve(self, session, country, region, city):
+        """
+        :param country: {name, code} или None
+        :param region: {name, code} или None
+        :param city: Название города ("Toronto")
+        :return: Идентификатор города или None
+        """
+
+        for city_id, region_keys, country_keys in self.index(session).get(fold(city), []):
+            if region is not None and not self.__matches(region, region_keys):
+                continue
+            if country is not None and not self.__matches(country, country_keys):
+                continue
+            return city_id
+        return None
+
+    @staticmethod
+    def __matches(location, keys):
+        name, code = keys
+        return fold(location.get('name')) == name or fold(location.get('code')) == code
+
+
+class CategoryResolver(ReferenceCache):
+    def load(self, session):
+        categories = [
+            (category_id, name)
+            for category_id, name in session.query(models.Category.id, models.Category.name).order_by(models.Category.id)
+        ]
+
+        aliases = {}
+        for source, name, category_id in session.query(
+            models.CategoryName.source, models.CategoryName.name, models.CategoryName.category_id
+        ).all():
+            aliases.setdefault(source, {})[category_id] = name
+
+        return {
+            'categories': categories,
+            'aliases': aliases,
+            'names': {
+                source: {fold(name): category_id for category_id, name in names.items()}
+                for source, names in aliases.items()
+            },
+            'categories_by_name': {fold(name): category_id for category_id, name in categories},
+        }
+
+    def services(self, session, source, query_categories=None):
+        """
+        :return: [{id, name}, ...] как в ScraperAPI.get_services
+        """
+
+        index = self.index(session)
+        aliases = index['aliases'].get(source, {})
+        return [
+            {
+                'id': category_id,
+                'name': aliases.get(category_id, name)
+            }
+            for category_id, name in index['categories']
+            if query_categories is None or name in query_categories
+        ]
+
+    def resolve(self, session, source, name):
+        """
+        :param source: Название источника ("yelp")
+        :param name: Название категории в источнике или общее название ("Audiologist")
+        :return: Идентификатор категории или None
+        """
+
+        index = self.index(session)
+        category_id = index['names'].get(source, {}).get(fold(name))
+        if category_id is None:
+            category_id = index['categories_by_name'].get(fold(name))
+        return category_id
+
+
+locations = LocationResolver()
+categories = CategoryResolver()
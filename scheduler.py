@@ -0,0 +1,103 @@
+import asyncio
+import heapq
+import itertools
+
+
+class TaskScheduler:
+    """
+    Crawl frontier: a priority queue of (attempts, task) with completion tracking.
+
+    Tasks with fewer failed attempts go first, then deeper tasks (pages of an already started search
+    before new searches), then hosts take turns. `get` waits while other workers still run tasks
+    that may enqueue children and returns None only when the whole crawl is finished.
+
+    A planner feeding the queue is held as an unfinished task and waits for `wait_below` before
+    putting more tasks, so only the next part of the plan is kept in memory.
+    """
+
+    def __init__(self):
+        self.__heap = []
+        self.__counter = itertools.count()
+        self.__host_turns = {}
+        self.__unfinished = 0
+        self.__condition = None
+        self.__drained = None
+
+    def __len__(self):
+        return self.__unfinished
+
+    @property
+    def queued(self):
+        return len(self.__heap)
+
+    def __conditions(self):
+        # Created lazily to bind to the running event loop. Producers waiting for room
+        # share the lock, but are not woken by every put
+        if self.__condition is None:
+            lock = asyncio.Lock()
+            self.__condition = asyncio.Condition(lock)
+            self.__drained = asyncio.Condition(lock)
+        return self.__condition, self.__drained
+
+    @property
+    def condition(self):
+        return self.__conditions()[0]
+
+    @property
+    def drained(self):
+        return self.__conditions()[1]
+
+    async def put(self, task, attempts):
+        host = getattr(task, 'host', None)
+        host_turn = self.__host_turns.get(host, 0)
+        self.__host_turns[host] = host_turn + 1
+
+        priority = (-attempts, -getattr(task, 'depth', 0), host_turn, next(self.__counter))
+
+        async with self.condition:
+            heapq.heappush(self.__heap, (priority, attempts, task))
+            self.__unfinished += 1
+            self.condition.notify()
+
+    async def get(self):
+        """
+        :return: (attempts, task) или None, если все задачи выполнены
+        """
+
+        async with self.condition:
+            while len(self.__heap) == 0:
+                if self.__unfinished == 0:
+                    return None
+                await self.condition.wait()
+
+            _, attempts, task = heapq.heappop(self.__heap)
+            self.drained.notify()
+            return attempts, task
+
+    async def hold(self):
+        """
+        Counts a producer as an unfinished task, so `get` does not return None before the producer
+        is released with `done`
+        """
+
+        async with self.condition:
+            self.__unfinished += 1
+
+    async def wait_below(self, count):
+        """
+        Waits until fewer than `count` tasks are queued
+        """
+
+        async with self.drained:
+            while len(self.__heap) >= count:
+                await self.drained.wait()
+
+    async def done(self):
+        """
+        Marks a task returned by `get` as finished. Retries must be put before calling it.
+        """
+
+        async with self.condition:
+            self.__unfinished -= 1
+            if self.__unfinished == 0:
+                self.condition.notify_all()
@@ -1,6 +1,6 @@
-from .yelp import ScrapeYelp
-from .google import ReviewGoogle
-from .opencare import ReviewOpencare
+from .yelp import ScrapeYelp, SearchFacilityYelp, ExtractFacilityYelp
+from .google import ReviewGoogle, ListGoogle, MatchGoogle
+from .opencare import ReviewOpencare, MatchOpencare
 
 
 SCRAPER_SOURCES = {
@@ -12,4 +12,14 @@ REVIEWS_SOURCES = {
     'opencare': ReviewOpencare
 }
 
-__all__ = (SCRAPER_SOURCES, REVIEWS_SOURCES)
+# Task classes by name, used to restore a saved crawl frontier
+TASK_KINDS = {
+    task.__name__: task
+    for task in (
+        ScrapeYelp, SearchFacilityYelp, ExtractFacilityYelp,
+        ReviewGoogle, ListGoogle, MatchGoogle,
+        ReviewOpencare, MatchOpencare
+    )
+}
+
+__all__ = (SCRAPER_SOURCES, REVIEWS_SOURCES, TASK_KINDS)
@@ -1,31 +1,97 @@
-import asyncio
 import urllib.parse
 
-import bs4
-import re
+import matching
 
+from . import parsing
 from .task import Task, ReviewTask
 
 
 class ReviewGoogle(ReviewTask):
+    # HostLimiter settings for the hosts of the source
+    rate_limits = {
+        'www.google.com': {'rate': 0.5, 'burst': 2, 'proxy_rate': 1 / 30, 'proxy_burst': 1},
+    }
+
+    async def __call__(self, session, proxy_address):
+        # Facilities with recently fetched reviews are not searched again
+        facilities = await self.freshness.stale_facilities(self.api, 'google', self.facilities)
+        if len(facilities) == 0:
+            return
+
+        # One local search of the service matches many facilities, the rest are searched one by one
+        await self.task_factory(
+            ListGoogle,
+            query=f"{self.service['name']}, {self.city['name']}, {self.region['name']}",
+            location=f"{self.region['name']}, {self.city['name']}",
+            facilities=facilities
+        )
+
+
+def match_url(location, facility):
+    return 'https://www.google.com/search?q=' + urllib.parse.quote(f"{location}, {facility['name']}")
+
+
+class ListGoogle(Task):
+    """
+    Local results (tbm=lcl) of a service in a city. Ratings of the listed facilities are taken
+    from the cards, the facilities missing from `pages` pages of results fall back to MatchGoogle.
+    """
+
+    depth = 1
+    pages = 3
+    page_size = 20
+
+    def __init__(self, query, location, facilities, start=0, **kwargs):
+        super().__init__(**kwargs)
+        self.query = query
+        self.location = location
+        self.facilities = facilities
+        self.start = start
+        self.page_url = 'https://www.google.com/search?tbm=lcl&q=' + urllib.parse.quote(query) + (
+            f'&start={start}' if start > 0 else ''
+        )
+
     async def __call__(self, session, proxy_address):
-        for facility in self.facilities:
-            await self.task_factory(lambda **kwargs: MatchGoogle(
-                url='https://www.google.com/search?q=' + urllib.parse.quote(
-                    f"{self.region['name']}, {self.city['name']}, {facility['name']}"
-                ),
-                facility=facility,
-                **kwargs
-            ))
+        async with session.get(self.page_url, proxy=proxy_address, timeout=10) as response:
+            text = await response.text()
+
+        listing = await parsing.run(parsing.extract_google_local, text)
 
+        matched = set()
+        for facility, clinic, confidence in matching.match_listing(self.facilities, listing['clinics']):
+            if confidence < 1.0:
+                print("<!>", clinic['name'], 'matched', facility['name'], f"({confidence:.2f})")
 
-def validate(page):
-    if page.select_one('form#captcha-form') is not None:
-        raise asyncio.TimeoutError('Google captcha error. Need to use another proxy')
-    return page
+            matched.add(facility['id'])
+            await self.api.queue_facility_reviews(
+                facility_id=facility['id'],
+                source='google',
+                rating=clinic['rating'],
+                count=clinic['count']
+            )
+
+        misses = [facility for facility in self.facilities if facility['id'] not in matched]
+        if len(misses) > 0 and listing['more'] and self.start + self.page_size < self.pages * self.page_size:
+            await self.task_factory(
+                ListGoogle,
+                query=self.query,
+                location=self.location,
+                facilities=misses,
+                start=self.start + self.page_size
+            )
+        else:
+            for facility in misses:
+                await self.task_factory(MatchGoogle, url=match_url(self.location, facility), facility=facility)
+
+        print("done", self, f"{len(self.facilities) - len(misses)}/{len(self.facilities)} matched")
+
+    def __repr__(self):
+        return f'google listing {self.page_url}'
 
 
 class MatchGoogle(Task):
+    depth = 2
+
     def __init__(self, url, facility, **kwargs):
         super().__init__(**kwargs)
         self.page_url = url
@@ -33,54 +99,28 @@ class MatchGoogle(Task):
 
     async def __call__(self, session, proxy_address):
         async with session.get(self.page_url, proxy=proxy_address, timeout=10) as response:
-            page = validate(bs4.BeautifulSoup(await response.text(), 'html.parser'))
-
-        clinic_name = page.select_one('.xpdopen .kp-header [role="heading"] span')
-        if clinic_name is None:
-            return
-
-        rating_stars_element = page.select_one('div span.rtng')
-        if rating_stars_element is None:
-            return
+            text = await response.text()
 
-        rating_stars = float(rating_stars_element.text.replace(',', '.'))
+        clinic = await parsing.run(parsing.extract_google_reviews, text)
 
-        rating_count_element = page.select_one('div span.rtng ~ span a span')
-        if rating_stars_element is None:
+        if clinic is None:
             return
 
-        rating_count = int(re.sub('[^\d]*', '', rating_count_element.text))
-
-        await self.api.post_facility_reviews(
+        await self.api.queue_facility_reviews(
             facility_id=self.facility['id'],
             source='google',
-            rating=rating_stars,
-            count=rating_count
+            rating=clinic['rating'],
+            count=clinic['count']
         )
 
-        for star_badge in page.select('[role="main"] .slp.f'):
-            source_cite = star_badge.parent.select_one('cite')
-            if source_cite is None:
-                continue
-
-            source_match = re.search(r"//[^.]+?\.([^\s]+)\.[^.]+", source_cite.text)
-            if source_match is None:
-                continue
-
-            rating_match = re.search(r":[^\d]*([\d.]+)[^\d]+(\d+)", star_badge.text.replace(',', '.'))
-            if rating_match is None:
-                continue
-
-            source, = source_match.groups()
-            rating, count = rating_match.groups()
-
-            print("<!>", source, 'for', self.facility['id'])
+        for review in clinic['sources']:
+            print("<!>", review['source'], 'for', self.facility['id'])
 
-            await self.api.post_facility_reviews(
+            await self.api.queue_facility_reviews(
                 facility_id=self.facility['id'],
-                source=source,
-                rating=float(rating),
-                count=int(count)
+                source=review['source'],
+                rating=review['rating'],
+                count=review['count']
             )
 
         print("done", self)
@@ -1,48 +1,53 @@
-import bs4
+import matching
 
+from . import parsing
 from .task import Task, ReviewTask
 
 
 class ReviewOpencare(ReviewTask):
+    # HostLimiter settings for the hosts of the source
+    rate_limits = {
+        'www.opencare.com': {'rate': 1.0, 'burst': 3},
+    }
+
     async def __call__(self, session, proxy_address):
+        # The listing page is fetched only if some of the facilities have stale reviews
+        facilities = await self.freshness.stale_facilities(self.api, 'opencare', self.facilities)
+        if len(facilities) == 0:
+            return
+
         region = str.lower(self.region['code'])
         city = str.lower(self.city['name']).replace(' ', '-')
         service = str.lower(self.service['name'])
 
-        await self.task_factory(lambda **kwargs: MatchOpencare(
+        await self.task_factory(
+            MatchOpencare,
             page_url=''.join(['https://www.opencare.com/', service, '/', city, '-', region, '/']),
-            facilities=self.facilities,
-            **kwargs
-        ))
+            facilities=facilities
+        )
 
 
 class MatchOpencare(Task):
+    depth = 1
+
     def __init__(self, page_url, facilities, **kwargs):
         super().__init__(**kwargs)
         self.page_url = page_url
-
-        # Just dict: name -> id
-        self.facilities = {
-            facility['name']: facility['id']
-            for facility in facilities
-        }
+        self.facilities = facilities
 
     async def __call__(self, session, proxy_address):
         async with session.get(self.page_url) as response:
-            page = bs4.BeautifulSoup(await response.text(), 'html.parser')
-
-        for media_info in page.select('.media-body .col-info'):
-            clinic_link = media_info.select_one('h4 a')
-            clinic_name = clinic_link.text
-            if clinic_name in self.facilities:
-                rating_count_element = media_info.select_one('address + * .text-muted')
-                if rating_count_element is not None:
-                    rating_stars = len(media_info.select('.fa-star')) + len(media_info.select('.fa-star-half-o')) / 2
-                    rating_count = int(rating_count_element.text.strip('()'))
-
-                    await self.api.post_facility_reviews(
-                        facility_id=self.facilities[clinic_name],
-                        source='opencare',
-                        rating=rating_stars,
-                        count=rating_count
-                    )
+            text = await response.text()
+
+        clinics = await parsing.run(parsing.extract_opencare_listing, text)
+
+        for facility, clinic, confidence in matching.match_listing(self.facilities, clinics):
+            if confidence < 1.0:
+                print("<!>", clinic['name'], 'matched', facility['name'], f"({confidence:.2f})")
+
+            await self.api.queue_facility_reviews(
+                facility_id=facility['id'],
+                source='opencare',
+                rating=clinic['rating'],
+                count=clinic['count']
+            )
@@ -0,0 +1,398 @@
+"""
+HTML extraction shared by the scrapers. Every `extract_*` function takes the page text and returns
+plain data, so parsers can be benchmarked and re-run over cached pages without the network.
+
+Pages are parsed with lxml when it is installed (html.parser otherwise) and, where the selectors allow,
+only the elements the extraction needs are built (SoupStrainer). The scrapers call the extraction through
+`run`, which executes it in a process pool so parsing does not block the network I/O of the event loop.
+"""
+import asyncio
+import concurrent.futures
+import html
+import importlib.util
+import json
+import os
+import re
+import urllib.parse
+
+import bs4
+
+from .task import BlockedError
+
+if importlib.util.find_spec('lxml') is not None:
+    BACKENDS = ('lxml', 'html.parser')
+else:
+    BACKENDS = ('html.parser',)
+
+backend = BACKENDS[0]
+strain = True
+
+
+class ParserPool:
+    """
+    Process pool of the extraction. The pool is created on the first use, zero processes
+    run the extraction in the event loop thread.
+    """
+
+    def __init__(self, processes=None):
+        self.processes = os.cpu_count() if processes is None else processes
+        self.__executor = None
+
+    @property
+    def executor(self):
+        if self.__executor is None and self.processes > 0:
+            self.__executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.processes)
+        return self.__executor
+
+    async def run(self, function, *args):
+        if self.executor is None:
+            return function(*args)
+
+        # Workers do not share the module settings, they are passed with every call
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, _configured, backend, strain, function, *args
+        )
+
+    def close(self):
+        if self.__executor is not None:
+            self.__executor.shutdown()
+            self.__executor = None
+
+
+pool = ParserPool()
+
+
+def configure(parser_backend=None, restrict=None, processes=None):
+    """
+    :param parser_backend: Парсер BeautifulSoup ("lxml", "html.parser")
+    :param restrict: Строить только нужные элементы страницы (True)
+    :param processes: Число процессов извлечения (по числу ядер, 0 - в потоке event loop)
+    """
+
+    global backend, strain, pool
+    if parser_backend is not None:
+        if parser_backend not in BACKENDS:
+            raise ValueError(f"HTML parser {parser_backend} is not available, use one of {BACKENDS}")
+        backend = parser_backend
+    if restrict is not None:
+        strain = restrict
+    if processes is not None:
+        pool.close()
+        pool = ParserPool(processes)
+
+
+def _configured(parser_backend, restrict, function, *args):
+    configure(parser_backend=parser_backend, restrict=restrict)
+    return function(*args)
+
+
+async def run(function, *args):
+    """
+    :param function: Функция извлечения (extract_yelp_facility)
+    :return: Результат функции, выполненной в пуле процессов
+    """
+
+    return await pool.run(function, *args)
+
+
+def only(classes=(), tags=None):
+    """
+    :param classes: Элементы с одним из классов
+    :param tags: {tag name: {attribute: value}} элементы с атрибутами (None - с любым значением)
+    :return: SoupStrainer, оставляющий только эти элементы (с содержимым)
+    """
+
+    classes = set(classes)
+    tags = tags or {}
+
+    def match(name, attrs):
+        if name in tags and all(
+            key in attrs if value is None else attrs.get(key) == value
+            for key, value in tags[name].items()
+        ):
+            return True
+
+        class_names = attrs.get('class') or ()
+        if isinstance(class_names, str):
+            class_names = class_names.split()
+        return not classes.isdisjoint(class_names)
+
+    return bs4.SoupStrainer(match)
+
+
+def parse(text, strainer=None):
+    return bs4.BeautifulSoup(text, backend, parse_only=strainer if strain else None)
+
+
+YELP_SEARCH = only(
+    ['indexed-biz-name', 'pagination-results-window', 'page-of-pages', 'y-container_content--maintenance'],
+    {'form': {'name': 'captcha_form'}}
+)
+YELP_FACILITY = only(
+    [
+        'biz-page-header', 'biz-page-title', 'biz-website', 'from-biz-owner-content',
+        'y-container_content--maintenance'
+    ],
+    {
+        'script': {'type': 'application/ld+json'},
+        'div': {'data-map-state': None},
+        'span': {'itemprop': None},
+        'form': {'name': 'captcha_form'},
+    }
+)
+OPENCARE_LISTING = only(['media-body'])
+GOOGLE_LOCAL = only(['VkpGBb'], {'a': {'id': 'pnnext'}, 'form': {'id': 'captcha-form'}})
+
+
+def validate_yelp(page):
+    if page.select_one('.y-container_content--maintenance') is not None:
+        raise BlockedError('Yelp access error. Need to use another proxy')
+
+    if page.select_one('form[name="captcha_form"]') is not None:
+        raise BlockedError('Yelp access error. Need to use another proxy')
+
+    return page
+
+
+def validate_google(page):
+    if page.select_one('form#captcha-form') is not None:
+        raise BlockedError('Google captcha error. Need to use another proxy')
+    return page
+
+
+def extract_yelp_search(text, page_url):
+    """
+    :return: {
+        clinic_urls: [URL, ...] ссылки на страницы клиник из результатов поиска,
+        total: Число результатов поиска ("Showing 1-10 of 236") или None,
+        pages: Число страниц результатов ("Page 1 of 24") или None
+    }
+    """
+
+    page = validate_yelp(parse(text, YELP_SEARCH))
+
+    clinic_urls = []
+    for media_clinic in page.select('span.indexed-biz-name'):
+        clinic_link = media_clinic.select_one('a')
+        if clinic_link is not None:
+            # The query (?osq=Dentists) differs between searches, the business is identified by the path
+            clinic_path = urllib.parse.urlsplit(clinic_link.attrs.get('href')).path
+            clinic_urls.append(urllib.parse.urljoin(page_url, clinic_path))
+
+    total = None
+    results_window = page.select_one('.pagination-results-window')
+    if results_window is not None:
+        total_match = re.search(r"of\s+([\d,]+)", results_window.text)
+        if total_match is not None:
+            total = int(total_match.group(1).replace(',', ''))
+
+    pages = None
+    page_of_pages = page.select_one('.page-of-pages')
+    if page_of_pages is not None:
+        pages_match = re.search(r"of\s+([\d,]+)", page_of_pages.text)
+        if pages_match is not None:
+            pages = int(pages_match.group(1).replace(',', ''))
+
+    return {
+        'clinic_urls': clinic_urls,
+        'total': total,
+        'pages': pages,
+    }
+
+
+def extract_yelp_facility(text):
+    """
+    :return: {
+        name, region_code, city_name, about, logo, phone, website, address, geocoords, postal_code,
+        categories: [category name, ...],
+        rating: {count, stars}
+    } или None, если на странице нет данных клиники
+    """
+
+    page = validate_yelp(parse(text, YELP_FACILITY))
+
+    json_script = page.select_one('script[type="application/ld+json"]')
+    json_text = json_script.text
+    json_data = json.JSONDecoder(strict=False).decode(json_text)
+
+    map_state_element = page.select_one('div[data-map-state]')
+    map_state_text = map_state_element.attrs['data-map-state']
+    map_state = json.JSONDecoder(strict=False).decode(html.unescape(map_state_text))
+
+    # Geocoords
+    geocoords = {'latitude': None, 'longitude': None}
+    for marker in map_state['markers']:
+        if marker.get('key') == 'starred_business':
+            geocoords = marker['location']
+
+    # Business Name
+    name_element = page.select_one('h1.biz-page-title')
+    if name_element is None:
+        return None
+
+    # Business Website URL
+    website_element = page.select_one('span.biz-website a')
+
+    # Business Address
+    address_element = page.select_one('span[itemprop="streetAddress"]')
+    if address_element is None:
+        return None
+
+    # Business City
+    city_name_element = page.select_one('span[itemprop="addressLocality"]')
+    if city_name_element is None:
+        return None
+
+    # Business Region
+    region_code_element = page.select_one('span[itemprop="addressRegion"]')
+    if region_code_element is None:
+        return None
+
+    # About the Business
+    about = []
+    about_part = None
+    for about_element in page.select('.from-biz-owner-content > *'):
+        if about_element.name == 'h3':
+            if 'specialties' in about_element.text.lower():
+                about_part = 'specialties'
+            else:
+                about_part = None
+
+        elif about_part is not None:
+            about_text = about_element.text.strip()
+            if len(about_text) > 0:
+                about.append(about_text)
+
+    categories = []
+    for category in page.select('.biz-page-header .category-str-list a'):
+        categories.append(str.strip(category.text))
+
+    rating = {
+        'count': 0,
+        'stars': 0
+    }
+    if 'aggregateRating' in json_data:
+        rating = {
+            'count': json_data['aggregateRating']['reviewCount'],
+            'stars': json_data['aggregateRating']['ratingValue']
+        }
+
+    return {
+        'name': str.strip(name_element.text),
+        'region_code': str.strip(region_code_element.text),
+        'city_name': str.strip(city_name_element.text),
+        'about': '\n'.join(about),
+        'logo': json_data['image'],
+        'phone': json_data['telephone'],
+        'website': website_element.text if website_element is not None else None,
+        'address': str.strip(address_element.text),
+        'geocoords': geocoords,
+        'postal_code': json_data['address']['postalCode'],
+        'categories': categories,
+        'rating': rating,
+    }
+
+
+def extract_google_reviews(text):
+    """
+    :return: {
+        name, rating, count,
+        sources: [{source, rating, count}, ...] рейтинги других сайтов из результатов поиска
+    } или None, если в выдаче нет карточки клиники
+    """
+
+    # The knowledge panel and the results are scattered over the page, it is parsed whole
+    page = validate_google(parse(text))
+
+    clinic_name = page.select_one('.xpdopen .kp-header [role="heading"] span')
+    if clinic_name is None:
+        return None
+
+    rating_stars_element = page.select_one('div span.rtng')
+    if rating_stars_element is None:
+        return None
+
+    rating_count_element = page.select_one('div span.rtng ~ span a span')
+    if rating_count_element is None:
+        return None
+
+    sources = []
+    for star_badge in page.select('[role="main"] .slp.f'):
+        source_cite = star_badge.parent.select_one('cite')
+        if source_cite is None:
+            continue
+
+        source_match = re.search(r"//[^.]+?\.([^\s]+)\.[^.]+", source_cite.text)
+        if source_match is None:
+            continue
+
+        rating_match = re.search(r":[^\d]*([\d.]+)[^\d]+(\d+)", star_badge.text.replace(',', '.'))
+        if rating_match is None:
+            continue
+
+        source, = source_match.groups()
+        rating, count = rating_match.groups()
+        sources.append({
+            'source': source,
+            'rating': float(rating),
+            'count': int(count)
+        })
+
+    return {
+        'name': clinic_name.text,
+        'rating': float(rating_stars_element.text.replace(',', '.')),
+        'count': int(re.sub(r'[^\d]*', '', rating_count_element.text)),
+        'sources': sources
+    }
+
+
+def extract_google_local(text):
+    """
+    :return: {
+        clinics: [{name, rating, count}, ...] карточки локальной выдачи (tbm=lcl),
+        more: Есть следующая страница выдачи
+    }
+    """
+
+    page = validate_google(parse(text, GOOGLE_LOCAL))
+
+    clinics = []
+    for card in page.select('.VkpGBb'):
+        name_element = card.select_one('.dbg0pd')
+        rating_element = card.select_one('.BTtC6e, span.rtng')
+        if name_element is None or rating_element is None:
+            continue
+
+        count_match = re.search(r"\(([\d\s.,\u00a0]+)\)", card.text)
+        clinics.append({
+            'name': name_element.text.strip(),
+            'rating': float(rating_element.text.replace(',', '.')),
+            'count': int(re.sub(r'[^\d]*', '', count_match.group(1))) if count_match is not None else 0
+        })
+
+    return {
+        'clinics': clinics,
+        'more': page.select_one('a#pnnext') is not None
+    }
+
+
+def extract_opencare_listing(text):
+    """
+    :return: [{name, rating, count}, ...] клиники страницы с отзывами
+    """
+
+    page = parse(text, OPENCARE_LISTING)
+
+    clinics = []
+    for media_info in page.select('.media-body .col-info'):
+        clinic_link = media_info.select_one('h4 a')
+        rating_count_element = media_info.select_one('address + * .text-muted')
+        if clinic_link is None or rating_count_element is None:
+            continue
+
+        clinics.append({
+            'name': clinic_link.text,
+            'rating': len(media_info.select('.fa-star')) + len(media_info.select('.fa-star-half-o')) / 2,
+            'count': int(rating_count_element.text.strip('()'))
+        })
+    return clinics
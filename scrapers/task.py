@@ -1,16 +1,52 @@
+import asyncio
+import datetime
+import urllib.parse
+
 from api_client import ScraperAPI
+from freshness import FreshnessPolicy
+
+
+class BlockedError(asyncio.TimeoutError):
+    """
+    The host answered with a captcha or a maintenance page instead of the content
+    """
 
 
 class Task:
+    # Position in the crawl: planning tasks are 0, their children 1 and so on
+    depth = 0
+    # Tasks of the page are queued once a run, whatever their other parameters
+    unique_page = False
+
     def __init__(self, **kwargs):
         self.api: ScraperAPI = kwargs['api']
         self.task_factory = kwargs['task_factory']
+        self.freshness: FreshnessPolicy = kwargs.get('freshness') or FreshnessPolicy(max_age=datetime.timedelta(0))
+
+    @classmethod
+    async def merge(cls, api, task, **params):
+        """
+        Called when a unique page is queued again in the run, e.g. found by another search
+
+        :param task: Задача страницы, если она еще не выполнена, иначе None
+        :param params: Параметры повторной задачи
+        :return: Новые параметры задачи task для журнала или None, если задача не изменилась
+        """
+
+    @property
+    def host(self):
+        page_url = getattr(self, 'page_url', None)
+        if page_url is None:
+            return None
+        return urllib.parse.urlsplit(page_url).netloc
 
     async def __call__(self, session, proxy_address):
         raise NotImplementedError
 
 
 class ScrapeTask(Task):
+    rate_limits = {}
+
     def __init__(self, service, country, region, city, **kwargs):
         super().__init__(**kwargs)
         self.service = service
@@ -23,6 +59,8 @@ class ScrapeTask(Task):
 
 
 class ReviewTask(Task):
+    rate_limits = {}
+
     def __init__(self, country, region, city, service, facilities, **kwargs):
         super().__init__(**kwargs)
         self.country = country
@@ -1,54 +1,83 @@
-import html
-import json
 import urllib.parse
-import asyncio
 import aiohttp
-import bs4
 
+from scrapers import parsing
 from scrapers.task import Task, ScrapeTask
 
 
-def validate(page):
-    if page.select_one('.y-container_content--maintenance') is not None:
-        raise asyncio.TimeoutError('Yelp access error. Need to use another proxy')
-
-    if page.select_one('form[name="captcha_form"]') is not None:
-        raise asyncio.TimeoutError('Yelp access error. Need to use another proxy')
-
-    return page
-
-
 class ScrapeYelp(ScrapeTask):
+    # HostLimiter settings for the hosts of the source
+    rate_limits = {
+        'www.yelp.com': {'rate': 1.0, 'burst': 5, 'proxy_rate': 0.1, 'proxy_burst': 1},
+    }
+
     async def __call__(self, session, proxy_address):
-        await self.task_factory(lambda **kwargs: SearchFacilityYelp(
+        await self.task_factory(
+            SearchFacilityYelp,
             page_url='https://www.yelp.com/search?find_desc='
             f'{urllib.parse.quote(self.service["name"])}&find_loc='
             f'{urllib.parse.quote(self.city["name"])},+'
             f'{urllib.parse.quote(self.region["name"])},+'
             f'{urllib.parse.quote(self.country["code"])}'
             '&sortby=rating',
-            **kwargs
-        ))
+            service_id=self.service['id']
+        )
 
     def __repr__(self):
         return f'create yelp task {self.service} in {self.city}'
 
 
 class SearchFacilityYelp(Task):
-    def __init__(self, page_url, **kwargs):
+    """
+    A page of Yelp search results. The first page reads the number of results and queues all the other
+    pages at once (`start` offsets), so they are fetched in parallel instead of following "Next" links.
+    """
+
+    depth = 1
+    page_size = 10
+    # Yelp does not serve results past the 24th page
+    max_pages = 24
+
+    def __init__(self, page_url, start=0, service_id=None, **kwargs):
         super().__init__(**kwargs)
-        self.page_url = page_url
+        self.search_url = page_url
+        self.start = start
+        self.service_id = service_id
+        self.page_url = page_url + (f'&start={start}' if start > 0 else '')
+
+    def page_count(self, search):
+        if search['total'] is not None:
+            pages = -(-search['total'] // self.page_size)
+        elif search['pages'] is not None:
+            pages = search['pages']
+        else:
+            pages = 1
+        return min(pages, self.max_pages)
 
     async def __call__(self, session: aiohttp.ClientSession, proxy_address):
         async with session.get(self.page_url, proxy=proxy_address, timeout=10) as response:
-            page = validate(bs4.BeautifulSoup(await response.text(), 'html.parser'))
+            text = await response.text()
 
-            for media_clinic in page.select('span.indexed-biz-name'):
-                clinic_link = media_clinic.select_one('a')
-                await self.task_factory(lambda **kwargs: ExtractFacilityYelp(
-                    page_url=urllib.parse.urljoin(self.page_url, clinic_link.attrs.get('href')),
-                    **kwargs
-                ))
+        search = await parsing.run(parsing.extract_yelp_search, text, self.page_url)
+
+        # Only the first page fans out, the other pages are leaves
+        if self.start == 0:
+            for page in range(1, self.page_count(search)):
+                await self.task_factory(
+                    SearchFacilityYelp,
+                    page_url=self.search_url,
+                    start=page * self.page_size,
+                    service_id=self.service_id
+                )
+
+        # Facilities fetched recently are not downloaded again, only linked to the service
+        stale_urls = await self.freshness.stale_pages(self.api, 'yelp', search['clinic_urls'])
+        for clinic_url in stale_urls:
+            await self.task_factory(ExtractFacilityYelp, page_url=clinic_url, service_id=self.service_id)
+
+        fresh_urls = set(search['clinic_urls']) - set(stale_urls)
+        if len(fresh_urls) > 0 and self.service_id is not None:
+            await self.api.queue_page_categories('yelp', sorted(fresh_urls), [self.service_id])
 
         print('done', self)
 
@@ -57,122 +86,66 @@ class SearchFacilityYelp(Task):
 
 
 class ExtractFacilityYelp(Task):
-    def __init__(self, page_url, **kwargs):
+    depth = 2
+    unique_page = True
+
+    def __init__(self, page_url, service_id=None, service_ids=(), **kwargs):
         super().__init__(**kwargs)
         self.page_url = page_url
+        # Services of all the searches which found the business in the run
+        self.service_ids = set(service_ids)
+        if service_id is not None:
+            self.service_ids.add(service_id)
+        self.queued = False
+
+    @classmethod
+    async def merge(cls, api, task, page_url, service_id=None, **params):
+        if service_id is None:
+            return
+
+        if task is not None and not task.queued:
+            task.service_ids.add(service_id)
+            return {'page_url': task.page_url, 'service_ids': sorted(task.service_ids)}
+
+        # The facility is already written or queued, it is found by its page
+        await api.queue_page_categories('yelp', [page_url], [service_id])
 
     async def __call__(self, session: aiohttp.ClientSession, proxy_address):
         async with session.get(self.page_url, proxy=proxy_address, timeout=10) as response:
-            page = validate(bs4.BeautifulSoup(await response.text(), 'html.parser'))
-
-            json_script = page.select_one('script[type="application/ld+json"]')
-            json_text = json_script.text
-            json_data = json.JSONDecoder(strict=False).decode(json_text)
-
-            map_state_element = page.select_one('div[data-map-state]')
-            map_state_text = map_state_element.attrs['data-map-state']
-            map_state = json.JSONDecoder(strict=False).decode(html.unescape(map_state_text))
-
-            # Geocoords
-            geocoords = {'latitude': None, 'longitude': None}
-            for marker in map_state['markers']:
-                if marker.get('key') == 'starred_business':
-                    geocoords = marker['location']
-
-            # Postal code
-            postal_code = json_data['address']['postalCode']
-
-            # Business Name
-            name_element = page.select_one('h1.biz-page-title')
-            if name_element is None:
-                return
-            name = str.strip(name_element.text)
-
-            # Business Logo URL
-            logo = json_data["image"]
-
-            # Business Website URL
-            website_element = page.select_one('span.biz-website a')
-            website = website_element.text if website_element is not None else None
-
-            # Business Address
-            address_element = page.select_one('span[itemprop="streetAddress"]')
-            if address_element is None:
-                return
-            address = str.strip(address_element.text)
-
-            # Business City
-            city_name_element = page.select_one('span[itemprop="addressLocality"]')
-            if city_name_element is None:
-                return
-            city_name = str.strip(city_name_element.text)
-
-            # Business Region
-            region_code_element = page.select_one('span[itemprop="addressRegion"]')
-            if region_code_element is None:
-                return
-            region_code = str.strip(region_code_element.text)
-
-            # Business Phone Number
-            phone = json_data['telephone']
-
-            # About the Business
-            about = []
-            about_part = None
-            for about_element in page.select('.from-biz-owner-content > *'):
-                if about_element.name == 'h3':
-                    if 'specialties' in about_element.text.lower():
-                        about_part = 'specialties'
-                    else:
-                        about_part = None
-
-                elif about_part is not None:
-                    about_text = about_element.text.strip()
-                    if len(about_text) > 0:
-                        about.append(about_text)
-
-            categories = []
-            for category in page.select('.biz-page-header .category-str-list a'):
-                categories.append(str.strip(category.text))
-
-            rating = {
-                'count': 0,
-                'stars': 0
-            }
-            if 'aggregateRating' in json_data:
-                rating = {
-                    'count': json_data['aggregateRating']['reviewCount'],
-                    'stars': json_data['aggregateRating']['ratingValue']
-                }
-
-            facility_id = await self.api.post_facility(
-                name=name,
-                country=None,
-                region={'code': region_code},
-                city=city_name,
-            )
-
-            if facility_id is None:
-                return
-
-            await self.api.post_facility_info(
-                facility_id=facility_id,
-                source='yelp',
-                about='\n'.join(about),
-                logo=logo,
-                phone=phone,
-                website=website,
-                address=address,
-                geocoords=geocoords,
-                postal_code=postal_code
-            )
-
-            await self.api.post_facility_reviews(
-                facility_id=facility_id,
-                source="yelp",
-                rating=rating['stars'],
-                count=rating['count']
-            )
+            text = await response.text()
+
+        facility = await parsing.run(parsing.extract_yelp_facility, text)
+
+        if facility is None:
+            return
+
+        # Services merged later are linked by the page
+        self.queued = True
+        await self.api.queue_facility(
+            name=facility['name'],
+            country=None,
+            region={'code': facility['region_code']},
+            city=facility['city_name'],
+            # All the categories of the business, not only the searched one
+            categories=facility['categories'],
+            category_ids=sorted(self.service_ids),
+            info={
+                'source': 'yelp',
+                'about': facility['about'],
+                'logo': facility['logo'],
+                'phone': facility['phone'],
+                'website': facility['website'],
+                'address': facility['address'],
+                'geocoords': facility['geocoords'],
+                'postal_code': facility['postal_code'],
+                'page_url': self.page_url
+            },
+            reviews=[{
+                'source': 'yelp',
+                'rating': facility['rating']['stars'],
+                'count': facility['rating']['count']
+            }]
+        )
 
         print('done', self)
 
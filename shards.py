@@ -0,0 +1,165 @@
+import collections
+import datetime
+import json
+
+import sqlalchemy
+
+import models
+
+
+Shard = collections.namedtuple('Shard', ['id', 'mode', 'source', 'params'])
+
+
+def utcnow():
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+class ShardQueue:
+    """
+    Queue of crawl shards in the shared database. The coordinator plans the shards of a run and
+    returns the shards of dead workers (no heartbeat for `timeout`) to the queue, workers on any host
+    claim shards one by one and mark them done:
+
+        pending -> claimed -> done
+           ^__________|  (heartbeat timeout)
+
+    A shard is claimed with a conditional UPDATE, so two workers never take the same pending shard.
+    """
+
+    def __init__(self, run):
+        self.run = run
+
+    async def plan(self, shards):
+        """
+        :param shards: [(mode, source, city_id, params), ...] params - JSON-совместимый dict
+        :return: Число новых шардов. Уже запланированные не изменяются
+        """
+
+        def insert_shards(session):
+            table = models.CrawlShard.__table__
+            before = session.query(models.CrawlShard).filter(models.CrawlShard.run == self.run).count()
+
+            session.execute(models.upsert(
+                session.bind.dialect.name, table, ['run', 'mode', 'source', 'city_id']
+            ), [
+                {
+                    'run': self.run,
+                    'mode': mode,
+                    'source': source,
+                    'city_id': city_id,
+                    'params': json.dumps(params, sort_keys=True),
+                    'status': 'pending',
+                    'claims': 0,
+                }
+                for mode, source, city_id, params in shards
+            ])
+            session.commit()
+
+            return session.query(models.CrawlShard).filter(models.CrawlShard.run == self.run).count() - before
+
+        if len(shards) == 0:
+            return 0
+
+        async with models.AsyncSession() as session:
+            return await session.run(insert_shards)
+
+    async def claim(self, worker):
+        """
+        :param worker: Имя воркера ("host-1234")
+        :return: Shard или None, если свободных шардов нет
+        """
+
+        def claim_shard(session):
+            table = models.CrawlShard.__table__
+            while True:
+                shard = session.query(
+                    models.CrawlShard.id, models.CrawlShard.mode, models.CrawlShard.source, models.CrawlShard.params
+                ).filter(
+                    models.CrawlShard.run == self.run,
+                    models.CrawlShard.status == 'pending'
+                ).order_by(models.CrawlShard.id).first()
+                if shard is None:
+                    return None
+
+                # Another worker may have claimed the shard since the select
+                result = session.execute(table.update().where(
+                    (table.c.id == shard.id) & (table.c.status == 'pending')
+                ).values(
+                    status='claimed',
+                    worker=worker,
+                    heartbeat=utcnow(),
+                    claims=table.c.claims + 1
+                ))
+                session.commit()
+
+                if result.rowcount == 1:
+                    return Shard(id=shard.id, mode=shard.mode, source=shard.source, params=json.loads(shard.params))
+
+        async with models.AsyncSession() as session:
+            return await session.run(claim_shard)
+
+    async def heartbeat(self, shard_id, worker):
+        """
+        :return: False, если шард передан другому воркеру
+        """
+
+        def update_heartbeat(session):
+            table = models.CrawlShard.__table__
+            result = session.execute(table.update().where(
+                (table.c.id == shard_id) & (table.c.worker == worker) & (table.c.status == 'claimed')
+            ).values(heartbeat=utcnow()))
+            session.commit()
+            return result.rowcount == 1
+
+        async with models.AsyncSession() as session:
+            return await session.run(update_heartbeat)
+
+    async def complete(self, shard_id, worker):
+        """
+        :return: False, если шард передан другому воркеру (он остается за новым воркером)
+        """
+
+        def complete_shard(session):
+            table = models.CrawlShard.__table__
+            result = session.execute(table.update().where(
+                (table.c.id == shard_id) & (table.c.worker == worker) & (table.c.status == 'claimed')
+            ).values(status='done', heartbeat=utcnow()))
+            session.commit()
+            return result.rowcount == 1
+
+        async with models.AsyncSession() as session:
+            return await session.run(complete_shard)
+
+    async def reassign(self, timeout):
+        """
+        :param timeout: datetime.timedelta без heartbeat, после которого воркер считается упавшим
+        :return: Число шардов, возвращенных в очередь
+        """
+
+        def reassign_shards(session):
+            table = models.CrawlShard.__table__
+            result = session.execute(table.update().where(
+                (table.c.run == self.run) & (table.c.status == 'claimed') & (table.c.heartbeat < utcnow() - timeout)
+            ).values(status='pending', worker=None))
+            session.commit()
+            return result.rowcount
+
+        async with models.AsyncSession() as session:
+            return await session.run(reassign_shards)
+
+    async def progress(self):
+        """
+        :return: {status: число шардов}
+        """
+
+        def count_shards(session):
+            return dict(session.query(
+                models.CrawlShard.status, sqlalchemy.func.count(models.CrawlShard.id)
+            ).filter(
+                models.CrawlShard.run == self.run
+            ).group_by(models.CrawlShard.status).all())
+
+        async with models.AsyncSession() as session:
+            progress = await session.run(count_shards)
+
+        return {status: progress.get(status, 0) for status in ('pending', 'claimed', 'done')}
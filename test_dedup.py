@@ -0,0 +1,59 @@
+import unittest
+
+from dedup import BloomFilter, SeenUrls, normalize_url
+
+
+class NormalizeUrlTest(unittest.TestCase):
+    def test_normalize_url(self):
+        self.assertEqual(
+            normalize_url('HTTPS://www.Yelp.com:443/biz/clinic/?b=2&a=1#reviews'),
+            'https://www.yelp.com/biz/clinic?a=1&b=2'
+        )
+        self.assertEqual(normalize_url('http://www.yelp.com:8080'), 'http://www.yelp.com:8080/')
+
+
+class BloomFilterTest(unittest.TestCase):
+    def test_sizing(self):
+        bloom = BloomFilter(1000, error_rate=0.001)
+        # m = -n ln(p) / ln(2)^2, k = m / n ln(2)
+        self.assertEqual(bloom.size, 14378)
+        self.assertEqual(bloom.hashes, 10)
+
+        self.assertEqual(BloomFilter(1000, error_rate=0.01).hashes, 7)
+        self.assertGreaterEqual(BloomFilter(1).size, 8)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter(10000, error_rate=0.01)
+        for number in range(10000):
+            bloom.add(f'https://www.yelp.com/biz/{number}')
+        # New items taken for added ones are not counted
+        self.assertGreater(len(bloom), 9900)
+
+        self.assertTrue(all(f'https://www.yelp.com/biz/{number}' in bloom for number in range(10000)))
+        false_positives = sum(f'https://www.yelp.com/biz/{number}' in bloom for number in range(10000, 30000))
+        self.assertLess(false_positives / 20000, 0.02)
+
+    def test_add_twice(self):
+        bloom = BloomFilter(100)
+        self.assertTrue(bloom.add('a'))
+        self.assertFalse(bloom.add('a'))
+        self.assertEqual(len(bloom), 1)
+
+
+class SeenUrlsTest(unittest.TestCase):
+    def test_exact(self):
+        seen = SeenUrls()
+        self.assertTrue(seen.add('https://www.yelp.com/biz/clinic'))
+        self.assertFalse(seen.add('https://WWW.yelp.com/biz/clinic/'))
+        self.assertIn('https://www.yelp.com/biz/clinic#reviews', seen)
+        self.assertEqual(len(seen), 1)
+
+    def test_bloom(self):
+        seen = SeenUrls(capacity=1000)
+        self.assertTrue(seen.add('https://www.yelp.com/biz/clinic'))
+        self.assertFalse(seen.add('https://www.yelp.com:443/biz/clinic'))
+        self.assertNotIn('https://www.yelp.com/biz/other', seen)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,103 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from frontier import FrontierJournal
+
+
+class FrontierJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'frontier.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def records(self):
+        with open(self.path) as f:
+            return [json.loads(line) for line in f]
+
+    def test_replay(self):
+        journal = FrontierJournal(self.path)
+        self.assertEqual(journal.load(), [])
+
+        search = journal.add('SearchFacilityYelp', {'page_url': 'https://www.yelp.com/search'}, 10)
+        extract = journal.add('ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a'}, 10)
+        failed = journal.add('ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/b'}, 10)
+        self.assertIsNone(journal.add('ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a'}, 10))
+
+        journal.retry(failed, 9)
+        journal.done(search)
+        journal.done(extract)
+        # Only the search is committed, the data of the extract is not written before the crash
+        journal.commit([search])
+        journal.close(completed=False)
+
+        resumed = FrontierJournal(self.path)
+        tasks = sorted(resumed.load(), key=lambda task: task[2]['page_url'])
+        self.assertEqual(tasks, [
+            (extract, 'ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a'}, 10),
+            (failed, 'ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/b'}, 9),
+        ])
+        self.assertIsNone(resumed.add('SearchFacilityYelp', {'page_url': 'https://www.yelp.com/search'}, 10))
+        resumed.close(completed=False)
+
+    def test_compaction(self):
+        journal = FrontierJournal(self.path)
+        journal.load()
+        keys = [journal.add('ExtractFacilityYelp', {'page_url': f'https://www.yelp.com/biz/{i}'}, 10) for i in range(3)]
+        for attempts in range(9, 5, -1):
+            journal.retry(keys[0], attempts)
+        journal.done(keys[1])
+        journal.commit(journal.checkpoint())
+        journal.close(completed=False)
+        self.assertEqual(len(self.records()), 3 + 4 + 1)
+
+        FrontierJournal(self.path).load()
+        records = self.records()
+        self.assertEqual(len(records), 3)
+        self.assertIn({'done': keys[1]}, records)
+        self.assertIn({
+            'add': keys[0], 'kind': 'ExtractFacilityYelp',
+            'params': {'page_url': 'https://www.yelp.com/biz/0'}, 'attempts': 6
+        }, records)
+
+    def test_update(self):
+        journal = FrontierJournal(self.path)
+        journal.load()
+        key = journal.add('ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a', 'service_id': 1}, 10)
+        journal.retry(key, 9)
+        journal.update(key, {'page_url': 'https://www.yelp.com/biz/a', 'service_ids': [1, 2]})
+        journal.update('unknown', {'page_url': 'https://www.yelp.com/biz/b'})
+        journal.close(completed=False)
+
+        expected = [(key, 'ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a', 'service_ids': [1, 2]}, 9)]
+        self.assertEqual(FrontierJournal(self.path).load(), expected)
+        # The compacted journal keeps the update
+        self.assertEqual(FrontierJournal(self.path).load(), expected)
+
+    def test_incomplete_last_line(self):
+        journal = FrontierJournal(self.path)
+        journal.load()
+        key = journal.add('ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a'}, 10)
+        journal.close(completed=False)
+        with open(self.path, 'a') as f:
+            f.write('{"done": "')
+
+        self.assertEqual([task[0] for task in FrontierJournal(self.path).load()], [key])
+
+    def test_completed_run_removes_journal(self):
+        journal = FrontierJournal(self.path)
+        journal.load()
+        key = journal.add('ExtractFacilityYelp', {'page_url': 'https://www.yelp.com/biz/a'}, 10)
+        journal.done(key)
+        journal.commit(journal.checkpoint())
+        journal.close(completed=True)
+
+        self.assertFalse(os.path.exists(self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import unittest
+
+import matching
+
+
+class NormalizeTest(unittest.TestCase):
+    def test_normalize(self):
+        self.assertEqual(matching.normalize("Dr. Smith's Dental & Co"), 'dr smiths dental')
+        self.assertEqual(matching.normalize('Clinique Dentaire Élysée Inc.'), 'clinique dentaire elysee')
+        self.assertEqual(matching.normalize('Toronto Dental Centre'), matching.normalize('Toronto Dental Center'))
+
+    def test_trigrams(self):
+        self.assertEqual(matching.trigrams('dr'), {'  d', ' dr', 'dr '})
+        self.assertEqual(matching.trigrams(''), set())
+
+
+class NameIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = matching.NameIndex([
+            (1, 'Smile Dental'),
+            (2, 'Dr. John Smith Dentistry'),
+            (3, 'Bright Smile Dental Care'),
+        ])
+
+    def test_exact(self):
+        self.assertEqual(self.index.match('SMILE DENTAL INC'), (1, 1.0))
+
+    def test_near_miss(self):
+        key, confidence = self.index.match('Bright Smiles Dental Care')
+        self.assertEqual(key, 3)
+        self.assertGreaterEqual(confidence, matching.MIN_CONFIDENCE)
+
+    def test_different_businesses(self):
+        self.assertIsNone(self.index.match('Smiles Dental'))
+        self.assertIsNone(self.index.match('Dr. Joan Smith Dentistry'))
+        self.assertIsNone(self.index.match('Downtown Orthodontics'))
+
+    def test_ambiguous(self):
+        index = matching.NameIndex([(1, 'Bright Smile Dental Care'), (2, 'Bright Smiles Dental Care')])
+        # Both reach MIN_CONFIDENCE, the best one is not far enough ahead
+        self.assertTrue(all(
+            confidence >= matching.MIN_CONFIDENCE for _, confidence in index.candidates('Bright Smile Dental Cares')
+        ))
+        self.assertIsNone(index.match('Bright Smile Dental Cares'))
+
+    def test_candidates(self):
+        self.assertEqual(
+            [key for key, _ in self.index.candidates('Smiles Dental', min_confidence=0.5)],
+            [1, 3]
+        )
+
+
+class MatchListingTest(unittest.TestCase):
+    def test_match_listing(self):
+        facilities = [
+            {'id': 1, 'name': 'Smile Dental'},
+            {'id': 2, 'name': 'Smiles Dental'},
+            {'id': 3, 'name': 'Toronto Dental Centre'},
+            {'id': 4, 'name': 'Downtown Family Dentistry Group'},
+            {'id': 5, 'name': 'Bright Smile Dental Care'},
+        ]
+        clinics = [
+            {'name': 'Smile Dental'},
+            {'name': 'Toronto Dental Center'},
+            {'name': 'Downtown Family Dentistry Grp'},
+            {'name': 'Downtown Family Dentistry Group'},
+            {'name': 'Bright Smiles Dental Care'},
+            {'name': 'Uptown Orthodontics'},
+        ]
+
+        matches = matching.match_listing(facilities, clinics)
+        self.assertEqual(
+            sorted((facility['id'], clinic['name']) for facility, clinic, _ in matches),
+            [
+                (1, 'Smile Dental'),
+                (3, 'Toronto Dental Center'),
+                (4, 'Downtown Family Dentistry Group'),
+                (5, 'Bright Smiles Dental Care'),
+            ]
+        )
+
+    def test_facility_used_once(self):
+        facilities = [{'id': 1, 'name': 'Smile Dental'}]
+        clinics = [{'name': 'Smile Dental'}, {'name': 'Smile Dental Inc'}]
+
+        # Two equal entries are ambiguous, the facility is searched separately
+        self.assertEqual(matching.match_listing(facilities, clinics), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
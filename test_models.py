@@ -0,0 +1,71 @@
+import unittest
+from unittest import mock
+
+import sqlalchemy
+
+import models
+
+
+class SQLiteUpsertTest(unittest.TestCase):
+    def setUp(self):
+        self.engine = sqlalchemy.create_engine('sqlite://')
+        models.Model.metadata.create_all(self.engine)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def compile(self, statement):
+        return str(statement.compile(dialect=self.engine.dialect))
+
+    def test_compile_do_update(self):
+        statement = models.upsert('sqlite', models.Review.__table__, ['facility_id', 'source'], ['rating', 'count'])
+        self.assertTrue(self.compile(statement).endswith(
+            ' ON CONFLICT (facility_id, source) DO UPDATE SET rating = excluded.rating, count = excluded.count'
+        ))
+
+    def test_compile_expression_do_nothing(self):
+        table = models.Facility.__table__
+        statement = models.upsert('sqlite', table, [table.c.city_id, sqlalchemy.func.lower(table.c.name)])
+        self.assertTrue(self.compile(statement).endswith(' ON CONFLICT (city_id, lower(name)) DO NOTHING'))
+
+    def test_upsert(self):
+        table = models.Review.__table__
+        statement = models.upsert('sqlite', table, ['facility_id', 'source'], ['rating', 'count'])
+        self.engine.execute(statement, [
+            {'facility_id': 1, 'source': 'yelp', 'rating': 4.0, 'count': 10},
+            {'facility_id': 1, 'source': 'google', 'rating': 3.0, 'count': 5},
+        ])
+        self.engine.execute(statement, [{'facility_id': 1, 'source': 'yelp', 'rating': 4.5, 'count': 12}])
+
+        rows = self.engine.execute(
+            sqlalchemy.select([table.c.source, table.c.rating, table.c.count]).order_by(table.c.source)
+        ).fetchall()
+        self.assertEqual([tuple(row) for row in rows], [('google', 3.0, 5), ('yelp', 4.5, 12)])
+
+    def test_upsert_case_insensitive_name(self):
+        table = models.Facility.__table__
+        statement = models.upsert('sqlite', table, [table.c.city_id, sqlalchemy.func.lower(table.c.name)])
+        self.engine.execute(statement, [{'city_id': 1, 'name': 'Smile Dental'}])
+        self.engine.execute(statement, [{'city_id': 1, 'name': 'SMILE DENTAL'}, {'city_id': 2, 'name': 'Smile dental'}])
+
+        rows = self.engine.execute(sqlalchemy.select([table.c.city_id, table.c.name]).order_by(table.c.id)).fetchall()
+        self.assertEqual([tuple(row) for row in rows], [(1, 'Smile Dental'), (2, 'Smile dental')])
+
+    def test_unsupported_dialect(self):
+        with self.assertRaises(NotImplementedError):
+            models.upsert('mysql', models.Review.__table__, ['facility_id', 'source'])
+
+
+class DatabaseTest(unittest.TestCase):
+    def test_old_sqlite(self):
+        with mock.patch('sqlite3.sqlite_version_info', (3, 22, 0)), mock.patch('sqlite3.sqlite_version', '3.22.0'):
+            with self.assertRaisesRegex(RuntimeError, 'SQLite 3.22.0 is not supported'):
+                models.Database(url='sqlite://')
+
+    def test_sqlite(self):
+        with mock.patch('sqlite3.sqlite_version_info', (3, 24, 0)):
+            models.Database(url='sqlite://').close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import collections
+import random
+import unittest
+
+from proxies import WeightedSampler
+
+
+class WeightedSamplerTest(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+
+    def assertTotal(self, sampler, weights):
+        self.assertAlmostEqual(sampler.total, sum(weights.values()))
+        for key, weight in weights.items():
+            self.assertEqual(sampler.weight(key), weight)
+
+    def test_empty(self):
+        sampler = WeightedSampler()
+        self.assertIsNone(sampler.sample())
+
+        sampler.set('a', 0.0)
+        self.assertIsNone(sampler.sample())
+
+    def test_update(self):
+        sampler = WeightedSampler()
+        weights = {}
+        for _ in range(200):
+            key = f'proxy-{random.randrange(20)}'
+            if random.random() < 0.2:
+                sampler.remove(key)
+                weights.pop(key, None)
+            else:
+                weights[key] = random.choice([0.0, 0.5, 1.0, 3.0])
+                sampler.set(key, weights[key])
+
+            self.assertEqual(len(sampler), len(weights))
+            self.assertTotal(sampler, weights)
+
+    def test_removed_slot_is_reused(self):
+        sampler = WeightedSampler()
+        for key in 'abc':
+            sampler.set(key, 1.0)
+        sampler.remove('b')
+        sampler.set('d', 2.0)
+
+        self.assertNotIn('b', sampler)
+        self.assertTotal(sampler, {'a': 1.0, 'c': 1.0, 'd': 2.0})
+
+    def test_sample(self):
+        sampler = WeightedSampler()
+        weights = {'a': 1.0, 'b': 0.0, 'c': 3.0, 'd': 6.0, 'e': 0.0}
+        for key, weight in weights.items():
+            sampler.set(key, weight)
+        sampler.remove('e')
+
+        samples = 20000
+        counts = collections.Counter(sampler.sample() for _ in range(samples))
+        self.assertEqual(set(counts), {'a', 'c', 'd'})
+        for key in 'acd':
+            self.assertAlmostEqual(counts[key] / samples, weights[key] / 10, delta=0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
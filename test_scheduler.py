@@ -0,0 +1,103 @@
+import asyncio
+import unittest
+
+from scheduler import TaskScheduler
+
+
+class FakeTask:
+    def __init__(self, name, host=None, depth=0):
+        self.name = name
+        self.host = host
+        self.depth = depth
+
+
+class TaskSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def run_async(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, timeout=5))
+
+    @staticmethod
+    async def drain(scheduler):
+        names = []
+        while True:
+            item = await scheduler.get()
+            if item is None:
+                return names
+            names.append(item[1].name)
+            await scheduler.done()
+
+    def test_order(self):
+        async def schedule():
+            scheduler = TaskScheduler()
+            await scheduler.put(FakeTask('retried', depth=2), 9)
+            await scheduler.put(FakeTask('search', depth=1), 10)
+            await scheduler.put(FakeTask('extract', depth=2), 10)
+            await scheduler.put(FakeTask('plan'), 10)
+            return await self.drain(scheduler)
+
+        # Fewer failed attempts first, then deeper tasks
+        self.assertEqual(self.run_async(schedule()), ['extract', 'search', 'plan', 'retried'])
+
+    def test_hosts_take_turns(self):
+        async def schedule():
+            scheduler = TaskScheduler()
+            for name in ['a1', 'a2', 'a3']:
+                await scheduler.put(FakeTask(name, host='a.com'), 10)
+            for name in ['b1', 'b2']:
+                await scheduler.put(FakeTask(name, host='b.com'), 10)
+            return await self.drain(scheduler)
+
+        self.assertEqual(self.run_async(schedule()), ['a1', 'b1', 'a2', 'b2', 'a3'])
+
+    def test_get_waits_for_running_tasks(self):
+        async def schedule():
+            scheduler = TaskScheduler()
+            await scheduler.put(FakeTask('parent'), 10)
+
+            _, parent = await scheduler.get()
+            waiting = asyncio.ensure_future(scheduler.get())
+            await asyncio.sleep(0.01)
+            self.assertFalse(waiting.done())
+
+            # The running task enqueues a child before it is done
+            await scheduler.put(FakeTask('child'), 10)
+            await scheduler.done()
+            _, child = await waiting
+            await scheduler.done()
+
+            return [parent.name, child.name], await scheduler.get()
+
+        self.assertEqual(self.run_async(schedule()), (['parent', 'child'], None))
+
+    def test_wait_below(self):
+        async def schedule():
+            scheduler = TaskScheduler()
+            await scheduler.hold()
+            queued = []
+
+            async def feed():
+                for number in range(10):
+                    await scheduler.wait_below(3)
+                    await scheduler.put(FakeTask(number), 10)
+                    queued.append(scheduler.queued)
+                await scheduler.done()
+
+            feeder = asyncio.ensure_future(feed())
+            names = await self.drain(scheduler)
+            await feeder
+            return names, queued
+
+        names, queued = self.run_async(schedule())
+        self.assertEqual(sorted(names), list(range(10)))
+        self.assertLessEqual(max(queued), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+
+import tophealth
+from frontier import FrontierJournal
+from http_cache import HttpCache
+from scheduler import TaskScheduler
+from scrapers import parsing
+from scrapers.yelp import ExtractFacilityYelp
+
+CAPTCHA_URL = 'https://www.yelp.com/biz/captcha'
+BROKEN_URL = 'https://www.yelp.com/biz/broken'
+MISSING_URL = 'https://www.yelp.com/biz/missing'
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        parsing.configure(processes=0)
+
+        self.directory = tempfile.mkdtemp()
+        self.http_cache = HttpCache(os.path.join(self.directory, 'http-cache')).open()
+        self.http_cache.put(CAPTCHA_URL, b'<html><form name="captcha_form"></form></html>', 'utf-8')
+        # Changed markup the parser cannot read
+        self.http_cache.put(BROKEN_URL, b'<html><body><div>Redesigned page</div></body></html>', 'utf-8')
+
+        self.frontier = FrontierJournal(os.path.join(self.directory, 'frontier.journal'))
+        self.frontier.load()
+
+    def tearDown(self):
+        self.frontier.close(completed=False)
+        self.http_cache.close()
+        shutil.rmtree(self.directory)
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def test_replay_failures(self):
+        async def replay():
+            scheduler = TaskScheduler()
+            for page_url in [CAPTCHA_URL, BROKEN_URL, MISSING_URL]:
+                key = self.frontier.add('ExtractFacilityYelp', {'page_url': page_url}, 10)
+                task = ExtractFacilityYelp(page_url=page_url, api=None, task_factory=None)
+                task.key = key
+                await scheduler.put(task, 10)
+
+            await tophealth.execute_tasks(scheduler, None, None, self.frontier, self.http_cache, replay=True)
+            return len(scheduler)
+
+        unfinished = self.loop.run_until_complete(asyncio.wait_for(replay(), timeout=10))
+
+        self.assertEqual(unfinished, 0)
+        self.assertEqual(len(self.frontier.checkpoint()), 3)
+        self.assertEqual(self.http_cache.urls(), [BROKEN_URL])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,111 @@
+import asyncio
+import unittest
+
+import sqlalchemy.exc
+
+import models
+from writer import BatchWriter
+
+
+class BatchWriterTest(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        models.configure(url='sqlite://', pool_size=2)
+
+        self.batches = []
+        self.failures = []
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def write_batch(self, session, records):
+        if len(self.failures) > 0:
+            raise self.failures.pop(0)
+        if 'broken' in records:
+            raise sqlalchemy.exc.IntegrityError('INSERT', {}, Exception('broken'))
+        self.batches.append(list(records))
+
+    def written(self):
+        return [record for batch in self.batches for record in batch]
+
+    def test_batches(self):
+        async def write():
+            writer = BatchWriter(self.write_batch, batch_size=3, flush_interval=10)
+            for record in range(7):
+                await writer.put(record)
+            await writer.close()
+
+        self.loop.run_until_complete(write())
+        self.assertEqual(self.written(), list(range(7)))
+        self.assertTrue(all(len(batch) <= 3 for batch in self.batches))
+
+    def test_backpressure(self):
+        peak = []
+
+        def write_batch(session, records):
+            peak.append(len(records))
+            self.write_batch(session, records)
+
+        async def write():
+            writer = BatchWriter(write_batch, batch_size=5, flush_interval=10, max_buffered=10)
+            buffered = []
+            for record in range(50):
+                await writer.put(record)
+                buffered.append(len(self.written()))
+            await writer.close()
+            return [record + 1 - written for record, written in enumerate(buffered)]
+
+        unwritten = self.loop.run_until_complete(write())
+        self.assertLessEqual(max(unwritten), 10)
+        self.assertEqual(self.written(), list(range(50)))
+
+    def test_broken_record_is_skipped(self):
+        async def write():
+            writer = BatchWriter(self.write_batch, batch_size=4, flush_interval=10)
+            for record in [1, 2, 'broken', 3]:
+                await writer.put(record)
+            await writer.close()
+
+        self.loop.run_until_complete(write())
+        self.assertEqual(self.written(), [1, 2, 3])
+
+    def test_failed_flush_keeps_records(self):
+        self.failures.append(sqlalchemy.exc.OperationalError('INSERT', {}, Exception('database is locked')))
+
+        async def write():
+            writer = BatchWriter(self.write_batch, batch_size=10, flush_interval=10)
+            for record in range(3):
+                await writer.put(record)
+
+            with self.assertRaises(sqlalchemy.exc.OperationalError):
+                await writer.flush()
+            self.assertEqual(self.batches, [])
+
+            await writer.close()
+
+        self.loop.run_until_complete(write())
+        # The batch is not split on errors other than the data ones
+        self.assertEqual(self.batches, [[0, 1, 2]])
+
+    def test_after_flush(self):
+        flushes = []
+
+        async def after_flush():
+            flushes.append(len(self.written()))
+
+        async def write():
+            writer = BatchWriter(self.write_batch, batch_size=2, flush_interval=10, after_flush=after_flush)
+            await writer.flush()
+            for record in range(3):
+                await writer.put(record)
+            await writer.close()
+
+        self.loop.run_until_complete(write())
+        self.assertEqual(flushes[-1], 3)
+        self.assertTrue(all(written > 0 for written in flushes))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,27 @@
 import argparse
 import asyncio
-import random
+import datetime
+import os
+import socket
+import time
 import traceback
+import weakref
 
 import aiohttp
 from api_client import ScraperAPI
+from dedup import SeenUrls, normalize_url
+from freshness import FreshnessPolicy
+from frontier import FrontierJournal
+from http_cache import CacheMiss, CachedSession, HttpCache
+import models
 import scrapers
 
-from proxies import AsyncProxyFinder
+from proxies import AsyncProxyFinder, ProxyStore
+from ratelimit import HostLimiter
+from scheduler import TaskScheduler
+from shards import ShardQueue
+from scrapers import parsing
+from scrapers.task import BlockedError
 
 
 PROXY_ERRORS = (
@@ -19,142 +33,478 @@ PROXY_ERRORS = (
     asyncio.TimeoutError
 )
 
+PROXY_CHOICES = 3
+CHECKPOINT_INTERVAL = 5
+HEARTBEAT_INTERVAL = 30
+PROXY_SAVE_INTERVAL = 60
+PLANNER_HIGH_WATER = 1000
 
-async def execute_tasks(tasks, proxies, semaphore):
+SOURCES = {
+    'scrape': scrapers.SCRAPER_SOURCES,
+    'review': scrapers.REVIEWS_SOURCES,
+}
+
+
+async def checkpoint_frontier(frontier, api, stop, interval=CHECKPOINT_INTERVAL):
+    """
+    Records finished tasks in the frontier journal once their data is written
+    """
+
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+        keys = frontier.checkpoint()
+        await api.flush()
+        frontier.commit(keys)
+
+
+async def save_proxies(proxies, stop, interval=PROXY_SAVE_INTERVAL):
+    """
+    Saves the proxy statistics now and then, so a crashed run does not lose them
+    """
+
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+        proxies.save()
+
+
+async def heartbeat_shard(shard_queue, shard, worker, stop, interval=HEARTBEAT_INTERVAL):
+    """
+    Keeps the shard claimed while its tasks run
+    """
+
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), timeout=interval)
+        except asyncio.TimeoutError:
+            pass
+
+        if not stop.is_set() and not await shard_queue.heartbeat(shard.id, worker):
+            print(f"<!> Shard {shard.id} was reassigned to another worker")
+
+
+async def execute_tasks(scheduler, proxies, limiter, frontier, http_cache=None, replay=False):
     user_agent = 'Mozilla/5.0 (X11; CrOS x86_64 8172.45.0) ' \
                  'AppleWebKit/537.36 (KHTML, like Gecko) ' \
                  'Chrome/51.0.2704.64 Safari/537.36 '
 
-    async with aiohttp.ClientSession(headers={'User-Agent': user_agent}) as session:
+    async with aiohttp.ClientSession(headers={'User-Agent': user_agent}) as client_session:
+        session = client_session
+        if http_cache is not None:
+            session = CachedSession(client_session, http_cache, replay=replay)
+
         while True:
-            async with semaphore:
-                if len(tasks) == 0:
-                    break
-                attempts, task = tasks.pop(random.randint(1, len(tasks)) - 1)
+            item = await scheduler.get()
+            if item is None:
+                break
+            attempts, task = item
 
-            proxy_address = await proxies.get()
             try:
-                await task(session, proxy_address)
-                await proxies.report(proxy_address, failed=False)
+                # Replayed pages are read from the cache, no proxies and politeness delays
+                if replay:
+                    try:
+                        await task(session, None)
+                    except CacheMiss as ex:
+                        print(f"Not cached: {ex}")
+                    # Replays are not retried, the same cached page would fail again
+                    except Exception as ex:
+                        # A captcha page kept in the cache is not replayed again
+                        if isinstance(ex, BlockedError) and getattr(task, 'page_url', None) is not None:
+                            http_cache.discard(task.page_url)
+                        traceback.print_exc()
+                        print(ex, task)
+                    frontier.done(task.key)
+                    continue
+
+                # Skip proxies the host has blocked recently
+                for _ in range(PROXY_CHOICES):
+                    proxy_address = await proxies.get()
+                    if limiter.available(task.host, proxy_address):
+                        break
+
+                await limiter.acquire(task.host, proxy_address)
+                started = time.monotonic()
+                try:
+                    await task(session, proxy_address)
+                    frontier.done(task.key)
+                    # Planning tasks do not fetch pages, they say nothing of the proxy
+                    if task.host is not None:
+                        await proxies.report(proxy_address, failed=False, latency=time.monotonic() - started)
+                    limiter.report(task.host, proxy_address, blocked=False)
+
+                # Try again if proxy is not working
+                except PROXY_ERRORS as ex:
+                    if task.host is not None:
+                        await proxies.report(proxy_address, failed=True, latency=time.monotonic() - started)
+                    if isinstance(ex, BlockedError):
+                        limiter.report(task.host, proxy_address, blocked=True)
+                        # The captcha page was answered with 200 OK, do not keep it
+                        if http_cache is not None and getattr(task, 'page_url', None) is not None:
+                            http_cache.discard(task.page_url)
+                    frontier.retry(task.key, attempts - 0.1)
+                    await scheduler.put(task, attempts - 0.1)
+
+                # Try again and print the error
+                except Exception as ex:
+                    if attempts > 0:
+                        frontier.retry(task.key, attempts - 1)
+                        await scheduler.put(task, attempts - 1)
+                    else:
+                        # Out of attempts, a resumed run does not retry it either
+                        frontier.done(task.key)
+                    traceback.print_exc()
+                    print(ex, task)
+            finally:
+                await scheduler.done()
+
+
+async def plan_cities(api, mode, filter_source, filter_services, filter_city, filter_region, filter_country):
+    """
+    :return: [(source, country, region, city, services), ...] города и услуги источников режима
+    """
+
+    cities = []
+    for source in SOURCES[mode]:
+        if filter_source is not None and source not in filter_source:
+            continue
+
+        services = await api.get_services(source, filter_services)
+        locations = await api.get_locations(source, filter_city, filter_region, filter_country)
+
+        for country in locations:
+            for region in country['regions']:
+                for city in region['cities']:
+                    cities.append((
+                        source,
+                        {
+                            'name': country['name'],
+                            'code': country['code']
+                        },
+                        {
+                            'name': region['name'],
+                            'code': region['code']
+                        },
+                        city,
+                        services
+                    ))
+    return cities
+
+
+async def plan_tasks(api, mode, cities):
+    """
+    The first tasks of the cities: a search for every service or a review of the known facilities.
+    Review tasks are planned from keyset pages of the facilities of all cities and services.
+
+    :param cities: [(source, country, region, city, services), ...] как в plan_cities
+    :return: async generator (task class, params)
+    """
+
+    if mode == 'scrape':
+        for source, country, region, city, services in cities:
+            for service in services:
+                yield SOURCES[mode][source], {'service': service, 'country': country, 'region': region, 'city': city}
+
+    if mode == 'review':
+        sources_by_city = {}
+        service_ids = set()
+        for source, country, region, city, services in cities:
+            sources_by_city.setdefault(city['id'], []).append(
+                (source, country, region, city, {service['id']: service for service in services})
+            )
+            service_ids.update(service['id'] for service in services)
+
+        async for city_id, service_id, facilities in api.iter_facility_groups(service_ids, list(sources_by_city)):
+            for source, country, region, city, services in sources_by_city[city_id]:
+                if service_id in services:
+                    yield SOURCES[mode][source], {
+                        'service': services[service_id],
+                        'country': country,
+                        'region': region,
+                        'city': city,
+                        'facilities': facilities
+                    }
+
+
+async def feed_tasks(planner, task_factory, scheduler, high_water=PLANNER_HIGH_WATER):
+    """
+    Puts the planned tasks while fewer than `high_water` tasks are queued. The scheduler is held
+    by the caller before the workers start and released here when the plan is exhausted.
+    """
+
+    try:
+        async for task_class, params in planner:
+            await scheduler.wait_below(high_water)
+            await task_factory(task_class, **params)
+    finally:
+        await scheduler.done()
+
+
+async def resume_frontier(frontier, scheduler, create_task):
+    for key, kind, params, attempts in frontier.load():
+        await scheduler.put(create_task(key, scrapers.TASK_KINDS[kind], params), attempts)
+    if len(scheduler) > 0:
+        print(f"Resuming {len(scheduler)} tasks from {frontier.path}")
+
+
+async def crawl(scheduler, frontier, api, proxies, limiter, worker_count, http_cache=None, replay=False):
+    """
+    Runs the tasks of the scheduler and the tasks they put until all of them are finished
+    """
+
+    stop_checkpoints = asyncio.Event()
+    checkpoints = asyncio.ensure_future(checkpoint_frontier(frontier, api, stop_checkpoints))
+    proxy_saves = asyncio.ensure_future(save_proxies(proxies, stop_checkpoints))
+    await asyncio.gather(*(
+        execute_tasks(scheduler, proxies, limiter, frontier, http_cache, replay)
+        for _ in range(worker_count)
+    ))
+
+    stop_checkpoints.set()
+    await checkpoints
+    await proxy_saves
 
-            # Try again if proxy is not working
-            except PROXY_ERRORS:
-                await proxies.report(proxy_address, failed=True)
-                async with semaphore:
-                    tasks.append((attempts - 0.1, task))
 
-            # Try again and print the error
-            except Exception as ex:
-                if attempts > 0:
-                    tasks.append((attempts - 1, task))
-                traceback.print_exc()
-                print(ex, task)
+def add_filter_arguments(parser, sources):
+    parser.add_argument('--source', nargs='+', choices=list(sources))
+    parser.add_argument('--city', nargs='+', help="City for scraping")
+    parser.add_argument('--region', nargs='+', help="Region for scraping")
+    parser.add_argument('--country', nargs='+', help="Country for scraping")
+    parser.add_argument('--service', nargs='+', help="List of services")
 
 
 async def main():
     parser = argparse.ArgumentParser()
+    parser.add_argument('--database-url', default=models.DATABASE_URL, help="SQLAlchemy engine URL")
+    parser.add_argument('--database-pool-size', type=int, default=models.DATABASE_POOL_SIZE,
+                        help="Number of concurrent database sessions")
+    parser.add_argument('--batch-size', type=int, default=500, help="Number of records written in one transaction")
+    parser.add_argument('--flush-interval', type=float, default=0.5,
+                        help="Maximum delay in seconds before buffered records are written")
+    parser.add_argument('--http-cache', help="Directory of the scraped pages cache (http-cache)")
+    parser.add_argument('--replay', action='store_true',
+                        help="Read pages only from --http-cache, without network and proxies")
+    parser.add_argument('--html-parser', choices=parsing.BACKENDS, default=parsing.backend,
+                        help="BeautifulSoup parser of the scraped pages")
+    parser.add_argument('--parser-processes', type=int, default=os.cpu_count(),
+                        help="Processes parsing the scraped pages (0 parses in the event loop)")
+    parser.add_argument('--workers', type=int, default=20, help="Number of concurrently fetched pages")
+    parser.add_argument('--proxy-store', default='proxies.json',
+                        help="File keeping the proxy statistics between runs (empty to disable)")
+    parser.add_argument('--seen-capacity', type=int,
+                        help="Remember the queued business pages in a Bloom filter sized for the number of pages "
+                             "instead of an exact set (very large runs)")
     subparsers = parser.add_subparsers(dest='mode')
     subparsers.add_parser('init')
 
     scrape_parser = subparsers.add_parser('scrape')
-    scrape_parser.add_argument('--source', nargs='+', choices=list(scrapers.SCRAPER_SOURCES))
-    scrape_parser.add_argument('--city', nargs='+', help="City for scraping")
-    scrape_parser.add_argument('--region', nargs='+', help="Region for scraping")
-    scrape_parser.add_argument('--country', nargs='+', help="Country for scraping")
-    scrape_parser.add_argument('--service', nargs='+', help="List of services")
+    add_filter_arguments(scrape_parser, scrapers.SCRAPER_SOURCES)
+    scrape_parser.add_argument('--frontier', help="Crawl frontier journal (frontier-scrape.journal)")
+    scrape_parser.add_argument('--restart', action='store_true', help="Ignore the frontier of an interrupted run")
+    scrape_parser.add_argument('--max-age', type=float,
+                               help="Skip facilities fetched less than the days ago (per-source default, 0 disables)")
 
     review_parser = subparsers.add_parser('review')
-    review_parser.add_argument('--source', nargs='+', choices=list(scrapers.REVIEWS_SOURCES))
-    review_parser.add_argument('--city', nargs='+', help="City for scraping")
-    review_parser.add_argument('--region', nargs='+', help="Region for scraping")
-    review_parser.add_argument('--country', nargs='+', help="Country for scraping")
-    review_parser.add_argument('--service', nargs='+', help="List of services")
+    add_filter_arguments(review_parser, scrapers.REVIEWS_SOURCES)
+    review_parser.add_argument('--frontier', help="Crawl frontier journal (frontier-review.journal)")
+    review_parser.add_argument('--restart', action='store_true', help="Ignore the frontier of an interrupted run")
+    review_parser.add_argument('--max-age', type=float,
+                               help="Skip facilities fetched less than the days ago (per-source default, 0 disables)")
+
+    coordinate_parser = subparsers.add_parser('coordinate')
+    coordinate_parser.add_argument('crawl', choices=list(SOURCES), help="Mode of the sharded crawl")
+    add_filter_arguments(
+        coordinate_parser, list(scrapers.SCRAPER_SOURCES) + list(scrapers.REVIEWS_SOURCES)
+    )
+    coordinate_parser.add_argument('--run', required=True, help="Name of the sharded crawl (nationwide-2018-09)")
+    coordinate_parser.add_argument('--heartbeat-timeout', type=float, default=HEARTBEAT_INTERVAL * 4,
+                                   help="Seconds without a heartbeat before a shard is given to another worker")
+
+    work_parser = subparsers.add_parser('work')
+    work_parser.add_argument('--run', required=True, help="Name of the sharded crawl")
+    work_parser.add_argument('--worker', help="Name of the worker (host-pid)")
+    work_parser.add_argument('--max-age', type=float,
+                             help="Skip facilities fetched less than the days ago (per-source default, 0 disables)")
+
+    prune_parser = subparsers.add_parser('prune')
+    prune_parser.add_argument('--days', type=int, default=90, help="Keep facility info history for the days")
 
     args = parser.parse_args()
+    if args.replay and args.http_cache is None:
+        parser.error("--replay requires --http-cache")
+    models.configure(url=args.database_url, pool_size=args.database_pool_size)
+
+    if args.mode == 'prune':
+        # Database maintenance, independent of the crawl filters, proxies and caches
+        api = ScraperAPI(None)
+        deleted = await api.prune_facility_info_history(datetime.timedelta(days=args.days))
+        print(f"Deleted {deleted} facility info history records")
+        await api.close()
+        return
+
+    parsing.configure(parser_backend=args.html_parser, processes=args.parser_processes)
 
-    filter_source = list(set(args.source or [])) or None
-    filter_city = list(set(args.city or [])) or None
-    filter_region = list(set(args.region or [])) or None
-    filter_country = list(set(args.country or [])) or None
-    filter_services = list(set(args.service or [])) or None
+    filter_source = list(set(getattr(args, 'source', None) or [])) or None
+    filter_city = list(set(getattr(args, 'city', None) or [])) or None
+    filter_region = list(set(getattr(args, 'region', None) or [])) or None
+    filter_country = list(set(getattr(args, 'country', None) or [])) or None
+    filter_services = list(set(getattr(args, 'service', None) or [])) or None
 
     # todo: Change api address
     api_address = None
-    api = ScraperAPI(api_address)
-    proxies = AsyncProxyFinder()
-
-    semaphore = asyncio.Semaphore()
-    tasks = []
-
-    async def task_factory(partial_constructor):
-        async with semaphore:
-            maximum_attempts = 10
-            tasks.append((maximum_attempts, partial_constructor(
-                api=api,
-                task_factory=task_factory
-            )))
-
-    if args.mode == 'scrape':
-        for source, scraper in scrapers.SCRAPER_SOURCES.items():
-            if filter_source is not None and source not in filter_source:
-                continue
+    api = ScraperAPI(api_address, batch_size=args.batch_size, flush_interval=args.flush_interval)
+    proxies = AsyncProxyFinder(store=ProxyStore(args.proxy_store) if args.proxy_store else None)
+    http_cache = HttpCache(args.http_cache).open() if args.http_cache is not None else None
 
-            services = await api.get_services(source, filter_services)
-            locations = await api.get_locations(source, filter_city, filter_region, filter_country)
-
-            for country in locations:
-                for region in country['regions']:
-                    for city in region['cities']:
-                        for service in services:
-                            await task_factory(lambda **kwargs: scraper(
-                                service=service,
-                                country={
-                                    'name': country['name'],
-                                    'code': country['code']
-                                },
-                                region={
-                                    'name': region['name'],
-                                    'code': region['code']
-                                },
-                                city=city,
-                                **kwargs
-                            ))
-
-    if args.mode == 'review':
-        for source, scraper in scrapers.REVIEWS_SOURCES.items():
-            if filter_source is not None and source not in filter_source:
-                continue
+    max_age = getattr(args, 'max_age', None)
+    if max_age is None and args.replay:
+        # Replay re-runs the parsers over every cached page
+        max_age = 0
+    freshness = FreshnessPolicy(max_age=datetime.timedelta(days=max_age) if max_age is not None else None)
+
+    scheduler = TaskScheduler()
+    limiter = HostLimiter({
+        host: limit
+        for scraper in list(scrapers.SCRAPER_SOURCES.values()) + list(scrapers.REVIEWS_SOURCES.values())
+        for host, limit in scraper.rate_limits.items()
+    })
+
+    # Business pages found by several searches (overlapping categories, neighbouring cities) are fetched once
+    seen_urls = SeenUrls(capacity=args.seen_capacity)
+
+    # Queued tasks of unique pages, a page queued again is merged into its task
+    page_tasks = weakref.WeakValueDictionary()
 
-            services = await api.get_services(source, filter_services)
-            locations = await api.get_locations(source, filter_city, filter_region, filter_country)
-
-            for country in locations:
-                for region in country['regions']:
-                    for city in region['cities']:
-                        for service in services:
-                            facilities = await api.get_facilities(service['id'], city['id'])
-                            print(facilities)
-
-                            if len(facilities) > 0:
-                                await task_factory(lambda **kwargs: scraper(
-                                    service=service,
-                                    country={
-                                        'name': country['name'],
-                                        'code': country['code']
-                                    },
-                                    region={
-                                        'name': region['name'],
-                                        'code': region['code']
-                                    },
-                                    city=city,
-                                    facilities=facilities,
-                                    **kwargs
-                                ))
-
-    if len(tasks) > 0:
-        worker_count = 20
+    def create_task(key, task_class, params):
+        task = task_class(api=api, task_factory=task_factory, freshness=freshness, **params)
+        task.key = key
+
+        if task_class.unique_page:
+            seen_urls.add(params['page_url'])
+            page_tasks[normalize_url(params['page_url'])] = task
+        return task
+
+    async def task_factory(task_class, **params):
+        if task_class.unique_page and not seen_urls.add(params['page_url']):
+            task = page_tasks.get(normalize_url(params['page_url']))
+            merged_params = await task_class.merge(api, task, **params)
+            # A resumed run keeps what was merged, the duplicate is not journaled
+            if merged_params is not None:
+                frontier.update(task.key, merged_params)
+            return
+
+        maximum_attempts = 10
+        key = frontier.add(task_class.__name__, params, maximum_attempts)
+        if key is None:
+            return
+
+        await scheduler.put(create_task(key, task_class, params), maximum_attempts)
+
+    if args.mode in ('scrape', 'review', 'work') and not args.replay:
         asyncio.ensure_future(proxies.update_proxies())
-        await asyncio.gather(*(execute_tasks(tasks, proxies, semaphore) for _ in range(worker_count)))
+
+    frontier = None
+    if args.mode in ('scrape', 'review'):
+        default_frontier = f'frontier-{args.mode}-replay.journal' if args.replay else f'frontier-{args.mode}.journal'
+        frontier = FrontierJournal(args.frontier or default_frontier)
+        if args.restart and os.path.exists(frontier.path):
+            os.remove(frontier.path)
+
+        # Resume an interrupted run
+        await resume_frontier(frontier, scheduler, create_task)
+
+        cities = await plan_cities(
+            api, args.mode, filter_source, filter_services, filter_city, filter_region, filter_country
+        )
+
+        # Tasks are planned while the first ones are fetched
+        await scheduler.hold()
+        feeder = asyncio.ensure_future(feed_tasks(plan_tasks(api, args.mode, cities), task_factory, scheduler))
+        await crawl(scheduler, frontier, api, proxies, limiter, args.workers, http_cache, args.replay)
+        await feeder
+
+        frontier.close(completed=True)
+
+    if args.mode == 'coordinate':
+        shard_queue = ShardQueue(args.run)
+
+        cities = await plan_cities(
+            api, args.crawl, filter_source, filter_services, filter_city, filter_region, filter_country
+        )
+        planned = await shard_queue.plan([
+            (args.crawl, source, city['id'], {'country': country, 'region': region, 'city': city, 'services': services})
+            for source, country, region, city, services in cities
+        ])
+        print(f"Planned {planned} new shards of {args.run}")
+
+        # Give the shards of dead workers to the others until the run is finished
+        while True:
+            reassigned = await shard_queue.reassign(datetime.timedelta(seconds=args.heartbeat_timeout))
+            if reassigned > 0:
+                print(f"<!> {reassigned} shards of dead workers are pending again")
+
+            progress = await shard_queue.progress()
+            print(f"{args.run}: {progress['done']} done, {progress['claimed']} claimed, {progress['pending']} pending")
+            if progress['pending'] + progress['claimed'] == 0:
+                break
+
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+    if args.mode == 'work':
+        shard_queue = ShardQueue(args.run)
+        worker = args.worker or f'{socket.gethostname()}-{os.getpid()}'
+
+        while True:
+            shard = await shard_queue.claim(worker)
+            if shard is None:
+                progress = await shard_queue.progress()
+                if sum(progress.values()) == 0:
+                    # Workers may start before the coordinator has planned the run
+                    print(f"{worker}: waiting for the shards of {args.run}")
+                elif progress['claimed'] == 0:
+                    break
+
+                # Shards of workers that die are returned to the queue by the coordinator
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+                continue
+
+            print(f"{worker}: shard {shard.id} {shard.mode} {shard.source} {shard.params['city']['name']}")
+
+            # A shard resumes from its journal if it was interrupted on this host
+            scheduler = TaskScheduler()
+            frontier = FrontierJournal(f'frontier-{args.run}-{shard.id}.journal')
+            await resume_frontier(frontier, scheduler, create_task)
+
+            city = (
+                shard.source,
+                shard.params['country'], shard.params['region'], shard.params['city'], shard.params['services']
+            )
+            await scheduler.hold()
+            feeder = asyncio.ensure_future(feed_tasks(plan_tasks(api, shard.mode, [city]), task_factory, scheduler))
+
+            stop_heartbeats = asyncio.Event()
+            heartbeats = asyncio.ensure_future(heartbeat_shard(shard_queue, shard, worker, stop_heartbeats))
+            await crawl(scheduler, frontier, api, proxies, limiter, args.workers, http_cache, args.replay)
+            await feeder
+            stop_heartbeats.set()
+            await heartbeats
+
+            await api.flush()
+            frontier.close(completed=True)
+            if not await shard_queue.complete(shard.id, worker):
+                print(f"<!> Shard {shard.id} was reassigned to another worker, it stays claimed by that worker")
+
+    await api.close()
+    parsing.pool.close()
+
+    if http_cache is not None:
+        http_cache.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+import asyncio
+import traceback
+
+import sqlalchemy.exc
+
+import models
+
+
+class BatchWriter:
+    """
+    Buffers scraped records and writes them in bulk: one transaction per `batch_size`
+    records or every `flush_interval` seconds, whichever comes first. `put` waits while
+    `max_buffered` records are not written yet, so the scrapers do not outrun the database.
+
+    `write_batch(session, records)` is called on the database thread pool and must not commit,
+    the writer commits once per batch. A batch rejected for its data (IntegrityError, DataError) is
+    retried record by record to skip the broken ones, other errors fail the whole batch.
+
+    `after_flush()` is awaited once after a flush that wrote records, outside of the batch transactions.
+    """
+
+    def __init__(self, write_batch, batch_size=500, flush_interval=0.5, max_buffered=None, after_flush=None):
+        self.write_batch = write_batch
+        self.after_flush = after_flush
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered or 2 * batch_size
+
+        self.__records = []
+        self.__full = None
+        self.__drained = None
+        self.__lock = None
+        self.__task = None
+        self.__closed = False
+
+    def __start(self):
+        # Created lazily to bind to the running event loop
+        if self.__task is None:
+            self.__full = asyncio.Event()
+            self.__drained = asyncio.Event()
+            self.__lock = asyncio.Lock()
+            self.__task = asyncio.ensure_future(self.__flush_loop())
+
+    async def __flush_loop(self):
+        while not self.__closed:
+            try:
+                await asyncio.wait_for(self.__full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                await self.flush()
+            except Exception:
+                # The records stay buffered, the write is retried after the interval
+                traceback.print_exc()
+                print(f"<!> Failed to write {len(self.__records)} buffered records, retrying")
+                await asyncio.sleep(self.flush_interval)
+
+    async def put(self, record):
+        self.__start()
+        self.__records.append(record)
+        if len(self.__records) >= self.batch_size:
+            self.__full.set()
+
+        while len(self.__records) >= self.max_buffered and not self.__closed:
+            self.__drained.clear()
+            await self.__drained.wait()
+
+    async def flush(self):
+        if self.__lock is None:
+            return
+
+        async with self.__lock:
+            self.__full.clear()
+            written = False
+            while len(self.__records) > 0:
+                records = self.__records[:self.batch_size]
+
+                async with models.AsyncSession() as session:
+                    await session.run(self.__write, records)
+
+                # Removed only once written: after a failure the records are written again by the next flush
+                del self.__records[:len(records)]
+                self.__drained.set()
+                written = True
+
+            if written and self.after_flush is not None:
+                await self.after_flush()
+
+    def __write(self, session, records):
+        try:
+            self.write_batch(session, records)
+            session.commit()
+            return
+        except (sqlalchemy.exc.IntegrityError, sqlalchemy.exc.DataError):
+            session.rollback()
+            if len(records) == 1:
+                traceback.print_exc()
+                print("<!> Skipped record", records[0])
+                return
+        except Exception:
+            session.rollback()
+            raise
+
+        # Find the broken records without losing the rest of the batch
+        for record in records:
+            self.__write(session, [record])
+
+    async def close(self):
+        if self.__task is None:
+            return
+
+        self.__closed = True
+        self.__full.set()
+        await self.__task
+        await self.flush()